@@ -6,10 +6,18 @@ Purpose: Data class Association which takes SQL server parcel table with X/Y val
     then creates duplicate of parcel table with user-selected fields,
     then associates that temp table with the polygons, in simple 1/0 (yes/no)
 
+    Parcels can be tagged against several polygon layers at once (tag_layers). The parcel table is read once,
+    and each chunk of parcels is tagged for every layer before moving to the next chunk.
+
     The resulting association object has:
-        - dask dataframe of parcel table with polygon association
+        - dask dataframe of parcel table with polygon association. It is backed by a folder of parquet files
+            (one per chunk of parcels) in spill_dir, so the parcel table never has to fit in memory.
         - a "master" pyodbc connection that supports the global (## prefix) temp table staying open until closed.
+        - if temp_table_mode is True, a global temp table (temp_tbl) on the server with the uid and tag fields of
+            each parcel. Loaded with fast bulk inserts, so that aggregations joining tags to the parcel table's
+            value fields (e.g. sum_by_tag()) can run on the server instead of pulling the value fields over the network.
         - a run_sql method that allows queries to be done on the temp table.
+        - a pooled session (see sql_session.py) used for all other queries, so they do not each open a new connection.
 
     Typical workflow: create association object > run whatever queries you need > close association object.
 
@@ -23,20 +31,40 @@ Python Version: 3.x
 
 
 
-import re
+import sys
+import uuid
+import shutil
+import tempfile
 from pathlib import Path
 from dataclasses import dataclass, field
 from time import perf_counter
 
 import pyodbc
+import numpy as np
 import pandas as pd
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
+import dask
 import dask.dataframe as dd
 import geopandas as gpd
 import arcpy
 from arcgis.features import GeoAccessor, GeoSeriesAccessor
 
+# helper modules shared by several script folders (sql_session, polygon_cache, etc.)
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath('shared')))
 from sqlqry2pandas import sqlqry_to_df
+from sql_session import get_session
 from esri_file_to_dataframe import esri_to_df
+from polygon_cache import cached_polygons
+
+def _nullable_dtype(dtype):
+    # dtype that can also hold missing values (parcels in no polygon) without changing type from chunk to chunk
+    if pd.api.types.is_bool_dtype(dtype): return 'boolean'
+    if pd.api.types.is_integer_dtype(dtype): return 'Int64'
+    if pd.api.types.is_float_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype): return dtype
+    return 'string'
+
 
 @dataclass
 class AssociateTbl:
@@ -59,99 +87,298 @@ class AssociateTbl:
     servername: str='SQL-SVR'
     trustedconn: str='yes'
     auto_commit: bool=True
+    spill_dir: str=None # folder for tagged parcel parquet files. Temporary folder if not specified.
+
+    # more polygon layers to tag parcels with, in the same pass as fc_polygons. {tag field name: polygon fc} for
+    # 1/0 tags, or {tag field name: (polygon fc, polygon field)} to tag with the value of the polygon's field.
+    tag_layers: dict=field(default_factory=dict)
+
+    # if True, tags are loaded into global temp table on the server (see load_temp_table()). pcl_val_fields are
+    # not pulled from the server in this mode; join them to the temp table with run_sql() instead.
+    temp_table_mode: bool=False
 
     def __post_init__(self):
         
-        self.field_map = None # placeholder for possible future ability to use spatial join instead of simple 1/0 tag
+        self._temp_spill_dir = False # True if spill_dir is a temp folder made by this object
 
-        self.sql_driver = self.get_odbc_driver()
-        self.conn_str = f"DRIVER={self.sql_driver};" \
-            f"SERVER={self.servername};" \
-            f"DATABASE={self.dbname};" \
-            f"Trusted_Connection={self.trustedconn};"
+        # pooled connections for all queries that do not need the global temp table
+        self.session = get_session(self.dbname, servername=self.servername, trustedconn=self.trustedconn)
+        self.conn_str = self.session.conn_str
         
         # establish main connection that maintains global temp table 
         self.main_conn = pyodbc.connect(self.conn_str)
         self.main_conn.autocommit = self.auto_commit
 
-        # load polygons into dataframe
-        if not self.polygon_fields:
-            self.polygon_fields = [arcpy.Describe(self.fc_polygons).OIDFieldName] # if no poly fields specified, just use the OID field
-
-        polys_source_crs = arcpy.Describe(self.fc_polygons).SpatialReference.factoryCode
-        self.search_polys = esri_to_df(self.fc_polygons, include_geom=True, field_list=self.polygon_fields, 
-                                       crs_val=polys_source_crs).to_crs(self.sacog_crs)
-        # if not self.field_map: self.search_polys = self.search_polys.dissolve()
+        # {tag field: (polygon fc, polygon field to tag with, or None for 1/0 tag)}. fc_polygons is the first layer.
+        self.layers = {self.f_pcltag: (self.fc_polygons, None)}
+        for tagname, lyr in self.tag_layers.items():
+            self.layers[tagname] = (lyr, None) if isinstance(lyr, str) else tuple(lyr)
+
+        # load polygons of each layer into dataframe
+        self.layer_stats = {} # {tag field: dict of polygon count, parcels tagged, and time to load and tag}
+        self.layer_polys = {}
+        for tagname, (fc, src_field) in self.layers.items():
+            start_time = perf_counter()
+            fields = self.polygon_fields if tagname == self.f_pcltag else [src_field] if src_field else []
+            self.layer_polys[tagname] = self.load_polygons(fc, fields)
+            self.layer_stats[tagname] = {'polygons': self.layer_polys[tagname].shape[0], 'parcels_tagged': 0,
+                                         'load_secs': perf_counter() - start_time, 'tag_secs': 0.0}
+
+        self.search_polys = self.layer_polys[self.f_pcltag]
+
+        # {tag field: dtype of its values}. 1/0 tags are float; value tags get the polygon field's dtype.
+        self.tag_dtypes = {tagname: _nullable_dtype(self.layer_polys[tagname][src_field].dtype) if src_field
+                           else 'float64' for tagname, (fc, src_field) in self.layers.items()}
         
         # add 1/0 tags indicating if each parcel is in polygon area *NOTE* this does not filter polygons. POtential future improvement.
         # self.tag_parcels()
         self.dd_taggedpcls = self.make_tagged_pcl_tbl()
 
-    def get_odbc_driver(self):
-        # gets name of ODBC driver, with name "ODBC Driver <version> for SQL Server"
-        drivers = [d for d in pyodbc.drivers() if 'ODBC Driver ' in d]
-        
-        if len(drivers) == 0:
-            errmsg = f"ERROR. No usable ODBC Driver found for SQL Server." \
-            f"drivers found include {drivers}. Check ODBC Administrator program" \
-            "for more information."
-            
-            raise Exception (errmsg)
-        else:
-            d_versions = [re.findall('\d+', dv)[0] for dv in drivers]
-            latest_version = max([int(v) for v in d_versions])
-            driver = f"ODBC Driver {latest_version} for SQL Server"
-        
-            return driver
+        self.temp_tbl = None
+        if self.temp_table_mode:
+            self.load_temp_table()
 
+    def load_polygons(self, fc, fields):
+        # loads polygon fc into geodataframe in sacog_crs. If no fields specified, just uses the OID field
+        if not fields:
+            fields = [arcpy.Describe(fc).OIDFieldName]
 
-    def run_sql_newconn(self, sql_str, auto_commit=True):
-        # runs sql_str with a new connection object.
-        conn = pyodbc.connect(self.conn_str)
-        conn.autocommit = auto_commit
+        # polygons are cached on disk after the first load, until fc is changed (see polygon_cache.py)
+        def load_func():
+            polys_source_crs = arcpy.Describe(fc).SpatialReference.factoryCode
+            return esri_to_df(fc, include_geom=True, field_list=fields, crs_val=polys_source_crs).to_crs(self.sacog_crs)
 
-        cur = conn.cursor()
-        cur.execute(sql_str)
-        cur.commit()
-        cur.close()
+        return cached_polygons(fc, fields, self.sacog_crs, load_func, crs_mode='reproject')
+
+    def run_sql_newconn(self, sql_str):
+        # runs sql_str on a connection from the session pool rather than on main_conn.
+        self.session.execute(sql_str)
 
 
     def make_tagged_pcl_tbl(self, target_val=1, chunksize=100_000):
         # set up query for pulling and tagging points in polygon
         str_pcl_val_cols = ''
-        if len(self.pcl_val_fields) > 0:
+        if len(self.pcl_val_fields) > 0 and not self.temp_table_mode:
             str_pcl_val_cols = f", {', '.join(self.pcl_val_fields)}"
         pull_qry = f'SELECT {self.f_pcluid}, {self.f_pclx}, {self.f_pcly}{str_pcl_val_cols} FROM {self.pcltbl}'
         data_chunks = sqlqry_to_df(query_str=pull_qry, dbname=self.dbname, 
                                     servername=self.servername, trustedconn=self.trustedconn, 
-                                    chunk_size=chunksize)        
-
+                                    chunk_size=chunksize, use_arrow=True, xy_fields=(self.f_pclx, self.f_pcly),
+                                    crs=f"EPSG:{self.sacog_crs}", partition_field=self.f_pcluid, workers=4)
+
+        # each tagged chunk is written to its own parquet file instead of being held in memory
+        if not self.spill_dir:
+            self.spill_dir = tempfile.mkdtemp(prefix='associate_')
+            self._temp_spill_dir = True
+        out_dir = Path(self.spill_dir).joinpath(f"tagged_{self.f_pcltag}")
+        if out_dir.exists(): shutil.rmtree(out_dir) # files from previous run
+        out_dir.mkdir(parents=True)
+
+        poly_geoms = {}
+        for tagname, polys in self.layer_polys.items():
+            poly_geoms[tagname] = polys.geometry.values.to_numpy()
+            shapely.prepare(poly_geoms[tagname])
+
+        schema = None
         for i, chunk in enumerate(data_chunks):
-            # https://stackoverflow.com/questions/76121937/how-to-append-new-data-to-an-existing-parquet-file
-            chunk = gpd.GeoDataFrame(chunk, geometry=gpd.points_from_xy(chunk[self.f_pclx], chunk[self.f_pcly]), 
-                                     crs=f"EPSG:{self.sacog_crs}")
-            
-            tagged_pts = gpd.sjoin(chunk, self.search_polys, predicate='within')
-            del chunk['geometry'] # free up space
+            # one spatial index of the chunk's points is queried with each layer's (prepared) polygons. This is
+            # several times faster than querying an index of polygons with the points.
+            pt_tree = shapely.STRtree(chunk.geometry.values.to_numpy())
+            chunk = pd.DataFrame(chunk.drop(columns='geometry')).reset_index(drop=True) # free up space
+
+            for tagname, (fc, src_field) in self.layers.items():
+                start_time = perf_counter()
+                poly_idx, pt_idx = pt_tree.query(poly_geoms[tagname], predicate='contains')
+
+                if src_field:
+                    # parcel in more than one polygon gets value of the first polygon
+                    order = np.lexsort((poly_idx, pt_idx))
+                    pt_idx, poly_idx = pt_idx[order], poly_idx[order]
+                    pt_idx, first = np.unique(pt_idx, return_index=True)
+                    tag_vals = self.layer_polys[tagname][src_field].iloc[poly_idx[first]].to_numpy()
+                    # same dtype in every chunk, including chunks where no parcel is in any polygon
+                    tag_vals = pd.array(tag_vals, dtype=self.tag_dtypes[tagname])
+                    chunk[tagname] = pd.Series(tag_vals, index=pt_idx).reindex(chunk.index)
+                else:
+                    pt_idx = np.unique(pt_idx)
+                    tags = np.zeros(chunk.shape[0])
+                    tags[pt_idx] = target_val
+                    chunk[tagname] = tags
+
+                self.layer_stats[tagname]['parcels_tagged'] += len(pt_idx)
+                self.layer_stats[tagname]['tag_secs'] += perf_counter() - start_time
+
+            # all files get the same explicit schema, so that e.g. a column that is all null in one chunk
+            # does not get a different type (or type null) in that chunk's file
+            if schema is None: schema = self._spill_schema(pull_qry, chunk)
+            pqt_tbl = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            pq.write_table(pqt_tbl, out_dir.joinpath(f"part-{i:05d}.parquet"))
+
+        dd_master = dd.read_parquet(str(out_dir))
+        print(self.run_report())
 
-            tagged_pts[self.f_pcltag] = target_val
-            tagged_pts = tagged_pts[[self.f_pcluid, self.f_pcltag]]
+        return dd_master
+    
+    def _spill_schema(self, pull_qry, chunk):
+        """
+        Arrow schema of the tagged parcel files. Tag columns get the types of tag_dtypes, and parcel table columns
+        get the types the server reports for them, rather than types inferred from the values of any one chunk.
+        Columns whose type the driver does not report (e.g. SQLite stand-in) get the type they have in chunk.
+        """
+        sql_schema = self.session.query_to_arrow(f"SELECT * FROM ({pull_qry}) q WHERE 1 = 0").schema
+        chunk_schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+
+        fields = []
+        for fname in chunk.columns:
+            if fname in self.tag_dtypes:
+                empty_tag = pd.DataFrame({fname: pd.Series([], dtype=self.tag_dtypes[fname])})
+                ftype = pa.Schema.from_pandas(empty_tag, preserve_index=False).field(fname).type
+            elif fname in sql_schema.names and sql_schema.field(fname).type != pa.null():
+                ftype = sql_schema.field(fname).type
+            else:
+                ftype = chunk_schema.field(fname).type
+            fields.append(pa.field(fname, ftype))
+
+        return pa.schema(fields)
+
+    def load_temp_table(self, batch_size=50_000):
+        """
+        Creates global temp table on main_conn with uid and tag fields, and bulk-loads the tagged parcels
+        into it one partition at a time. Table stays on the server until main_conn is closed.
+        """
+        start_time = perf_counter()
+        self.temp_tbl = f"##assoc_{uuid.uuid4().hex[:12]}" # unique, since global temp tables are visible to all sessions
+
+        # uid field gets same data type as in parcel table. The UNION keeps SELECT INTO from copying any IDENTITY property.
+        tag_cols = list(self.layers.keys())
+        dtypes = self.dd_taggedpcls.dtypes
+        sql_types = {tag: 'FLOAT' if pd.api.types.is_float_dtype(dtypes[tag])
+                     else 'BIGINT' if pd.api.types.is_integer_dtype(dtypes[tag]) else 'NVARCHAR(255)'
+                     for tag in tag_cols}
+        str_tag_cols = ', '.join(f"CAST(NULL AS {sql_types[tag]}) AS {tag}" for tag in tag_cols)
+
+        cur = self.main_conn.cursor()
+        cur.execute(f"SELECT TOP 0 {self.f_pcluid}, {str_tag_cols} INTO {self.temp_tbl} FROM {self.pcltbl} " \
+                    f"UNION ALL SELECT TOP 0 {self.f_pcluid}, {str_tag_cols} FROM {self.pcltbl}")
+
+        cur.fast_executemany = True
+        sql_insert = f"INSERT INTO {self.temp_tbl} ({self.f_pcluid}, {', '.join(tag_cols)}) " \
+            f"VALUES ({', '.join(['?'] * (len(tag_cols) + 1))})"
+
+        rowcnt = 0
+        for part in self.dd_taggedpcls[[self.f_pcluid] + tag_cols].to_delayed():
+            df = part.compute()
+            df = df.astype(object).where(df.notna(), None) # NaN to NULL
+            rows = list(df.itertuples(index=False, name=None))
+            for i in range(0, len(rows), batch_size):
+                cur.executemany(sql_insert, rows[i:i + batch_size])
+            rowcnt += len(rows)
+
+        cur.execute(f"CREATE CLUSTERED INDEX idx_{self.temp_tbl[2:]} ON {self.temp_tbl} ({self.f_pcluid})")
+        self.main_conn.commit()
+        cur.close()
 
-            chunk = chunk.merge(tagged_pts, how='left', on=self.f_pcluid)
-            chunk[self.f_pcltag] = chunk[self.f_pcltag].fillna(0)
+        et_sec = round(perf_counter() - start_time, 1)
+        print(f"Loaded {rowcnt} tagged parcels into {self.temp_tbl} in {et_sec} seconds.")
 
-            ddchunk = dd.from_pandas(chunk, npartitions=1)
+    def run_sql(self, sql_str):
+        """
+        Runs sql_str on main_conn, which can see the global temp table (temp_tbl).
+        Returns dataframe of results if the query returns rows, otherwise None.
+        """
+        cur = self.main_conn.cursor()
+        cur.execute(sql_str)
 
-            if i == 0: 
-                dd_master = ddchunk
-            else:
-                dd_master = dd.concat([dd_master, ddchunk])
+        if cur.description is None:
+            self.main_conn.commit()
+            cur.close()
+            return None
 
-        return dd_master
-    
-    def export_associated_tbl(self, format='csv'):
-        # placeholder method in case you want to export associated parcel table to CSV or parquet, or even geoparquet
-        pass
+        cols = [d[0] for d in cur.description]
+        df = pd.DataFrame.from_records(cur.fetchall(), columns=cols)
+        cur.close()
+
+        return df
+
+    def sum_by_tag(self, val_fields, tag_field=None):
+        """
+        Sums parcel table's val_fields by tag value, on the server. Needs temp_table_mode=True.
+        tag_field = tag field to group by. Defaults to f_pcltag.
+        """
+        if not self.temp_tbl:
+            raise Exception("ERROR: no temp table loaded. Set temp_table_mode=True or run load_temp_table() first.")
+        tag_field = tag_field or self.f_pcltag
+
+        str_sums = ', '.join(f"SUM(p.{f}) AS {f}" for f in val_fields)
+        sql_agg = f"SELECT t.{tag_field}, COUNT(*) AS parcels, {str_sums} FROM {self.temp_tbl} t " \
+            f"INNER JOIN {self.pcltbl} p ON t.{self.f_pcluid} = p.{self.f_pcluid} GROUP BY t.{tag_field}"
+
+        return self.run_sql(sql_agg)
+
+    def run_report(self):
+        # returns dataframe with number of polygons, parcels tagged, and seconds to load and tag for each tag layer
+        return pd.DataFrame.from_dict(self.layer_stats, orient='index').rename_axis('tag_field').reset_index()
+
+    def close(self):
+        # closes main connection, which drops the global temp table, and deletes temp folder of tagged parcel files
+        self.main_conn.close()
+        if self._temp_spill_dir: shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def _write_partition(self, df, out_file, fmt, compression, row_group_rows, add_geometry, write_header):
+        # writes one partition of the tagged parcel table
+        if add_geometry:
+            df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[self.f_pclx].to_numpy(), df[self.f_pcly].to_numpy()),
+                                  crs=f"EPSG:{self.sacog_crs}")
+
+        if fmt == 'csv':
+            if add_geometry: df = pd.DataFrame(df.drop(columns='geometry')).assign(geometry=df.geometry.to_wkt())
+            df.to_csv(out_file, index=False, header=write_header, compression=compression)
+        else:
+            df.to_parquet(out_file, index=False, compression=compression or 'zstd', row_group_size=row_group_rows)
+
+        return df.shape[0]
+
+    def export_associated_tbl(self, out_path, format='csv', compression=None, row_group_rows=100_000,
+                              add_geometry=False, workers=4):
+        """
+        Writes tagged parcel table to out_path without loading the whole table into memory. Each partition
+        is written separately, with up to workers partitions being written at once.
+        format = 'csv' (single file), 'parquet' or 'geoparquet' (folder with one file per partition)
+        compression = e.g. 'gzip' for csv; 'zstd' (default) or 'snappy' for parquet.
+        row_group_rows = max number of rows in each parquet row group
+        add_geometry = if True, adds point geometry made from f_pclx/f_pcly (as WKT for csv). Always True for geoparquet.
+        Returns number of rows written.
+        """
+        start_time = perf_counter()
+        fmt = format.lower()
+        if fmt not in ('csv', 'parquet', 'geoparquet'):
+            raise Exception(f"ERROR: format must be 'csv', 'parquet', or 'geoparquet'. '{format}' was given.")
+        if fmt == 'geoparquet': add_geometry = True
+
+        # csv partitions go in a temp folder, then are appended into one file. Compressed (e.g. gzip) csv
+        # partitions can be appended too, since a series of compressed streams is still a valid compressed file.
+        out_path = Path(out_path)
+        part_dir = out_path.parent.joinpath(f"{out_path.name}_parts") if fmt == 'csv' else out_path
+        if part_dir.exists(): shutil.rmtree(part_dir)
+        part_dir.mkdir(parents=True)
+
+        ext = 'csv' if fmt == 'csv' else 'parquet'
+        tasks = [dask.delayed(self._write_partition)(part, part_dir.joinpath(f"part-{i:05d}.{ext}"), fmt, compression,
+                                                     row_group_rows, add_geometry, write_header=(i == 0))
+                 for i, part in enumerate(self.dd_taggedpcls.to_delayed())]
+        rowcnts = dask.compute(*tasks, scheduler='threads', num_workers=workers)
+
+        if fmt == 'csv':
+            with open(out_path, 'wb') as f_out:
+                for part_file in sorted(part_dir.glob(f"part-*.{ext}")):
+                    with open(part_file, 'rb') as f_in:
+                        shutil.copyfileobj(f_in, f_out)
+            shutil.rmtree(part_dir)
+
+        et_mins = round((perf_counter() - start_time) / 60, 2)
+        print(f"Exported {sum(rowcnts)} rows to {out_path} in {et_mins} minutes.")
+
+        return sum(rowcnts)
 
 
 
@@ -164,11 +391,16 @@ if __name__ == '__main__':
     # polygons you want to associate with points in table (e.g. want to find points in these polygons and tag points accordingly)
     source_polys = r'Q:\MTPSCS_2025\EquityAnalysis\Equity_Analysis_25.gdb\Birth_Rate_Higher_than_nat_avg'  # r'I:\Projects\Darren\2025BlueprintTables\Blueprint_Table_GIS\Blueprint_Table_GIS.gdb\EJ_2025_final'
 
+    # other polygon layers to tag parcels with in the same pass. {tag field: polygon fc} for 1/0 tags,
+    # or {tag field: (polygon fc, polygon field)} to tag with the polygon's field value
+    other_layers = {}
+
     # ============================================
     # seldom-changed ILUT field names
     f_x = 'XCOORD'
     f_y = 'YCOORD'
     f_uid = 'PARCELID' # field in target table indicating unique ID of each point.
 
-    example = AssociateTbl(db_name, parcel_data, f_x, f_y, f_uid, f_tagname, source_polys, pcl_val_fields=use_pcl_fields)
+    example = AssociateTbl(db_name, parcel_data, f_x, f_y, f_uid, f_tagname, source_polys, pcl_val_fields=use_pcl_fields,
+                           tag_layers=other_layers)
     import pdb; pdb.set_trace()
\ No newline at end of file
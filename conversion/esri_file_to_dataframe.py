@@ -8,19 +8,218 @@ Purpose: Converts ESRI file (File GDB table, SHP, or feature class) to either pa
         updates. This formula aims to use common ESRI and GeoPandas functions to maximize long-term reliability.
 
 
+    Columnar mode (columnar=True) pulls all attributes and geometry as column arrays, then builds the
+        geometry in a single vectorized shapely.from_wkb call instead of parsing WKT one row at a time. If arcpy
+        is not installed (e.g., on Linux), columnar mode reads through GDAL's OpenFileGDB driver via pyogrio.
+
+
 Author: Darren Conly
-Last Updated: Dec 2023
+Last Updated: Oct 2026
 Updated by: 
 Copyright:   (c) SACOG
 Python Version: 3.x
 """
 
+import re
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
 import pandas as pd
-import arcpy
+import shapely
 from shapely import wkt
 
+try:
+    import arcpy
+except ImportError:
+    arcpy = None # no ArcGIS Pro install; only the columnar (pyogrio) reader is available
+
+
+def _split_gdb_path(esri_obj_path):
+    # pyogrio needs the file GDB folder and the layer name separately, e.g. r'Q:\x.gdb\fc' -> (r'Q:\x.gdb', 'fc').
+    # Feature classes inside a feature dataset (x.gdb\dataset\fc) are addressed by the last name only.
+    # Shapefiles and other standalone files have no layer part.
+    gdb_match = re.match(r'(?P<gdb>.+?\.gdb)[\\/](?P<layer>.+)$', str(esri_obj_path), flags=re.IGNORECASE)
+    if not gdb_match:
+        return str(esri_obj_path), None
+
+    layer = re.split(r'[\\/]', gdb_match['layer'])[-1]
+    return gdb_match['gdb'], layer
+
+
+def _pyogrio_read_args(esri_obj_path, fields, sql_clause):
+    # GDAL ignores where-clause fields that are not among the selected columns, so if both a field list
+    # and a where clause are given, the selection is done as an OGR SQL query instead.
+    data_path, layer = _split_gdb_path(esri_obj_path)
+    if not (fields and sql_clause):
+        return data_path, {'layer': layer, 'columns': fields, 'where': sql_clause}
+
+    layer_name = layer or Path(data_path).stem
+    str_fields = ', '.join([f'"{f}"' for f in fields])
+    return data_path, {'sql': f'SELECT {str_fields} FROM "{layer_name}" WHERE {sql_clause}'}
+
+
+# numpy dtype of each ESRI integer field type
+ESRI_INT_DTYPES = {'SmallInteger': np.int16, 'Integer': np.int32, 'BigInteger': np.int64}
+
+
+def _arcpy_fields(esri_obj_path, field_list, include_geom):
+    if field_list: return field_list
+
+    # SHAPE@WKB is read separately, so leave out the raw geometry field. Blob and raster fields cannot be
+    # loaded into numpy arrays.
+    skip_types = ['Blob', 'Raster'] + (['Geometry'] if include_geom else [])
+    return [f.name for f in arcpy.ListFields(esri_obj_path) if f.type not in skip_types]
+
+
+def _numpy_null_values(esri_obj_path, fields):
+    # value arcpy puts in place of nulls for each nullable field; without one, it raises on the first null.
+    # Float nulls become NaN, date nulls NaT, and text nulls ''. Integer nulls get the smallest value of the
+    # field's type, which _array_to_df() changes back to NA.
+    null_vals = {}
+    for fld in arcpy.ListFields(esri_obj_path):
+        if fld.name not in fields or not fld.isNullable: continue
+        if fld.type in ESRI_INT_DTYPES:
+            null_vals[fld.name] = np.iinfo(ESRI_INT_DTYPES[fld.type]).min
+        elif fld.type in ('Single', 'Double'):
+            null_vals[fld.name] = np.nan
+        elif fld.type == 'Date':
+            null_vals[fld.name] = np.datetime64('NaT')
+        elif fld.type in ('String', 'GUID', 'GlobalID'):
+            null_vals[fld.name] = ''
+
+    return null_vals
+
+
+def _array_to_df(arr, fields, null_vals):
+    # structured numpy array to dataframe of typed columns, with integer null placeholders changed back to NA
+    attr_df = pd.DataFrame({f: arr[f] for f in fields}, columns=fields)
+    for fname, null_val in null_vals.items():
+        col = attr_df[fname].to_numpy()
+        if np.issubdtype(col.dtype, np.integer):
+            attr_df[fname] = pd.arrays.IntegerArray(col, col == null_val)
+
+    return attr_df
+
+
+def _read_wkb_arcpy(esri_obj_path, where_clause, oids):
+    # full geometries cannot go into a numpy array, so they are read on their own cursor and put in the
+    # same order as oids, the attribute rows
+    with arcpy.da.SearchCursor(esri_obj_path, ['OID@', 'SHAPE@WKB'], where_clause=where_clause) as cur:
+        rows = np.array(list(cur), dtype=object).reshape(-1, 2)
+
+    return rows[pd.Index(rows[:, 0]).get_indexer(oids), 1]
+
+
+def _read_columns_arcpy(esri_obj_path, fields, include_geom, sql_clause):
+    # attributes come back from arcpy as typed numpy arrays, one per field
+    null_vals = _numpy_null_values(esri_obj_path, fields)
+    arr = arcpy.da.TableToNumPyArray(esri_obj_path, fields + ['OID@'], where_clause=sql_clause,
+                                     null_value=null_vals or None)
+    attr_df = _array_to_df(arr, fields, null_vals)
+    wkb_geoms = _read_wkb_arcpy(esri_obj_path, sql_clause, arr['OID@']) if include_geom else None
+
+    return attr_df, wkb_geoms, None
+
+
+def _arcpy_chunk_clauses(esri_obj_path, sql_clause, chunk_rows):
+    # where clauses that each select a range of at most chunk_rows OIDs of the rows matching sql_clause
+    f_oid = arcpy.AddFieldDelimiters(esri_obj_path, arcpy.Describe(esri_obj_path).OIDFieldName)
+    oids = np.sort(arcpy.da.TableToNumPyArray(esri_obj_path, ['OID@'], where_clause=sql_clause)['OID@'])
+    for i in range(0, len(oids), chunk_rows):
+        oid_range = f"{f_oid} >= {oids[i]} AND {f_oid} <= {oids[min(i + chunk_rows, len(oids)) - 1]}"
+        yield f"({sql_clause}) AND {oid_range}" if sql_clause else oid_range
+
+
+def _arrow_to_columns(tbl, meta, fields, include_geom):
+    wkb_geoms = None
+    if include_geom:
+        f_wkb = meta['geometry_name'] or 'wkb_geometry'
+        wkb_geoms = tbl[f_wkb].to_numpy(zero_copy_only=False)
+        tbl = tbl.drop_columns([f_wkb])
+
+    attr_df = tbl.to_pandas()
+    if fields: attr_df = attr_df[fields] # keep user-specified field order
+
+    return attr_df, wkb_geoms
+
+
+def _read_columns_pyogrio(esri_obj_path, fields, include_geom, sql_clause):
+    # GDAL's OpenFileGDB driver returns typed Arrow columns, with geometry as a WKB column
+    from pyogrio import read_arrow
+
+    data_path, read_kwargs = _pyogrio_read_args(esri_obj_path, fields, sql_clause)
+    meta, tbl = read_arrow(data_path, read_geometry=include_geom, **read_kwargs)
+    attr_df, wkb_geoms = _arrow_to_columns(tbl, meta, fields, include_geom)
+
+    return attr_df, wkb_geoms, meta['crs']
+
+
+def _columns_to_gdf(attr_df, wkb_geoms, src_crs, esri_obj_path):
+    import geopandas as gpd
+
+    geoms = shapely.from_wkb(wkb_geoms)
+    has_geom = ~shapely.is_missing(geoms)
+    n_nogeom = int((~has_geom).sum())
+    if n_nogeom > 0:
+        print(f"\tWARNING: not loading {n_nogeom} features from {esri_obj_path} because they have no geometry")
+        attr_df = attr_df.loc[has_geom].reset_index(drop=True)
+        geoms = geoms[has_geom]
+
+    # if feature class already had field(s) named 'geometry', rename so they don't duplicate the geopandas geom field name
+    attr_df = attr_df.rename(columns={'geometry': 'geometry0'})
+
+    return gpd.GeoDataFrame(attr_df, geometry=geoms, crs=src_crs)
+
+
+def _finish_gdf(out_df, esri_obj_path, crs_val, dissolve, explode, warn_multi=True):
+    # CRS, dissolve, explode, and multipart check steps shared by the row-based and columnar readers
+
+    # only set if the input file has no CRS--this is not same thing as .to_crs(), which merely projects to a CRS
+    if crs_val: out_df = out_df.set_crs(crs_val, allow_override=True)
+
+    # dissolve to single zone so that, during spatial join, points don't erroneously tag to 2 overlapping zones.
+    if dissolve and out_df.shape[0] > 1: 
+        out_df = out_df.dissolve() 
+
+    # use to get rid of multipart geometries (optional)
+    if explode:
+        out_df = out_df.explode()
+
+    # check and warn about multipart features
+    gtypes = out_df.geometry.type.drop_duplicates().values
+    has_multi = any(['multi' in gt.lower() for gt in gtypes if gt])
+    if has_multi and warn_multi:
+        print(f"WARNING: Resulting GeoDataFrame from {esri_obj_path} has multipart feature types ({gtypes}). "
+              "Use geopandas .explode() method to convert to single parts if desired.")
+
+    return out_df
+
+
+def esri_to_df_columnar(esri_obj_path, include_geom, field_list=None, index_field=None, 
+                        crs_val=None, dissolve=False, explode=False, sql_clause=None):
+    """
+    Columnar version of esri_to_df(), with the same arguments and output. Attributes load as whole columns
+    and all geometries are built with one vectorized shapely.from_wkb call.
+    Uses arcpy if available, otherwise reads with pyogrio (GDAL OpenFileGDB driver).
+    """
+    if arcpy:
+        fields = _arcpy_fields(esri_obj_path, field_list, include_geom)
+        attr_df, wkb_geoms, src_crs = _read_columns_arcpy(esri_obj_path, fields, include_geom, sql_clause)
+    else:
+        attr_df, wkb_geoms, src_crs = _read_columns_pyogrio(esri_obj_path, field_list, include_geom, sql_clause)
+
+    if not include_geom:
+        if index_field: attr_df = attr_df.set_index(index_field)
+        return attr_df
+
+    out_df = _columns_to_gdf(attr_df, wkb_geoms, src_crs, esri_obj_path)
+
+    return _finish_gdf(out_df, esri_obj_path, crs_val, dissolve, explode)
+
+
 def esri_to_df(esri_obj_path, include_geom, field_list=None, index_field=None, 
-               crs_val=None, dissolve=False, explode=False, sql_clause=None):
+               crs_val=None, dissolve=False, explode=False, sql_clause=None, columnar=False):
     """
     Converts ESRI file (File GDB table, SHP, or feature class) to either pandas dataframe
     or geopandas geodataframe (if it is spatial data)
@@ -32,7 +231,14 @@ def esri_to_df(esri_obj_path, include_geom, field_list=None, index_field=None,
     index_field = if you want to choose a pre-existing field for the dataframe index. Optional.
     crs_val = crs, in geopandas CRS string format, that you want to apply to the resulting geodataframe. Optional.
     dissolve = True/False indicating if you want the resulting GDF to be dissolved to single feature.
+    explode = True/False indicating if you want multipart features split into single parts.
+    sql_clause = SQL where clause to filter which rows get loaded. Optional.
+    columnar = True/False. If True, uses the much faster columnar reader (esri_to_df_columnar). Always
+        used if arcpy is not installed.
     """
+    if columnar or not arcpy:
+        return esri_to_df_columnar(esri_obj_path, include_geom, field_list=field_list, index_field=index_field,
+                                   crs_val=crs_val, dissolve=dissolve, explode=explode, sql_clause=sql_clause)
 
     fields = field_list # should not be necessary, but was having issues where class properties were getting changed with this formula
     if not field_list:
@@ -71,33 +277,60 @@ def esri_to_df(esri_obj_path, include_geom, field_list=None, index_field=None,
         fields_gpd[fields_gpd.index(f_esrishp)] = f_gpdshape
         
         out_df = gpd.GeoDataFrame(data_rows, columns=fields_gpd, geometry=f_gpdshape)
+        out_df = _finish_gdf(out_df, esri_obj_path, crs_val, dissolve, explode)
+    else:
+        out_df = pd.DataFrame(data_rows, index=index_field, columns=fields)
 
-        # only set if the input file has no CRS--this is not same thing as .to_crs(), which merely projects to a CRS
-        if crs_val: out_df.crs = crs_val
 
-        # dissolve to single zone so that, during spatial join, points don't erroneously tag to 2 overlapping zones.
-        if dissolve and out_df.shape[0] > 1: 
-            out_df = out_df.dissolve() 
 
-        # use to get rid of multipart geometries (optional)
-        if explode:
-            out_df = out_df.explode()
+    return out_df
+
+def iter_esri_chunks(esri_obj_path, include_geom=True, chunk_rows=100_000, field_list=None, index_field=None, 
+                     crs_val=None, explode=False, sql_clause=None):
+    """
+    Generator version of esri_to_df(). Instead of loading the whole ESRI file at once, yields
+    dataframes/geodataframes of at most chunk_rows rows each (fewer after any rows with no geometry are dropped;
+    more if explode=True splits multipart features), so that large layers can be processed in constant memory.
+    Uses the same columnar reader as esri_to_df_columnar() and takes the same arguments, except:
+    chunk_rows = max number of input rows per chunk.
+    dissolve is not available, because it needs all features at once.
+    """
+    if arcpy:
+        fields = _arcpy_fields(esri_obj_path, field_list, include_geom)
 
-        # check and warn about multipart features
-        gtypes = out_df.geometry.type.drop_duplicates().values
-        has_multi = any(['multi' in gt.lower() for gt in gtypes])
-        if has_multi:
-            print(f"WARNING: Resulting GeoDataFrame from {esri_obj_path} has multipart feature types ({gtypes}). "
-                  "Use geopandas .explode() method to convert to single parts if desired.")
+        def read_chunks():
+            # each chunk is a range of OIDs, read into numpy arrays like esri_to_df_columnar()
+            for chunk_clause in _arcpy_chunk_clauses(esri_obj_path, sql_clause, chunk_rows):
+                yield _read_columns_arcpy(esri_obj_path, fields, include_geom, chunk_clause)
     else:
-        out_df = pd.DataFrame(data_rows, index=index_field, columns=fields)
+        import pyarrow as pa
+        from pyogrio import open_arrow
 
+        data_path, read_kwargs = _pyogrio_read_args(esri_obj_path, field_list, sql_clause)
 
+        def read_chunks():
+            with open_arrow(data_path, read_geometry=include_geom, batch_size=chunk_rows, 
+                            use_pyarrow=True, **read_kwargs) as (meta, reader):
+                for batch in reader:
+                    tbl = pa.Table.from_batches([batch])
+                    yield *_arrow_to_columns(tbl, meta, field_list, include_geom), meta['crs']
+
+    for i, (attr_df, wkb_geoms, src_crs) in enumerate(read_chunks()):
+        if not include_geom:
+            if index_field: attr_df = attr_df.set_index(index_field)
+            yield attr_df
+            continue
+
+        out_df = _columns_to_gdf(attr_df, wkb_geoms, src_crs, esri_obj_path)
+        # only warn about multipart features once, not for every chunk
+        yield _finish_gdf(out_df, esri_obj_path, crs_val, dissolve=False, explode=explode, warn_multi=(i == 0))
 
-    return out_df
 
 if __name__ == '__main__':
     test_fc = r'I:\Projects\Darren\PPA3_GIS\PPA3_GIS.gdb\EJ_2025_final'
 
-    gdf = esri_to_df(test_fc, include_geom=True, crs_val=2226)
-    import pdb; pdb.set_trace()
\ No newline at end of file
+    for use_columnar in [False, True]:
+        if use_columnar is False and not arcpy: continue
+        st = perf_counter()
+        gdf = esri_to_df(test_fc, include_geom=True, crs_val=2226, columnar=use_columnar)
+        print(f"columnar={use_columnar}: loaded {gdf.shape[0]} rows in {round(perf_counter() - st, 2)} seconds")
\ No newline at end of file
@@ -2,23 +2,88 @@
 Name: fc2parquet.py
 Purpose: converts ESRI feature classes to parquet
 
+    fc2parquet() streams the feature class in chunks and appends each chunk as a parquet row group, so
+    memory use stays constant regardless of feature class size. Output is GeoParquet (v1.1) with an optional
+    bbox covering column, which lets downstream readers skip row groups outside an area of interest.
+
+    batch_fc2parquet() converts many feature classes in parallel, one process per file, and skips any input
+    whose source fingerprint (path, size, modified time, schema, conversion settings) matches the fingerprint
+    stored in the existing output file's metadata.
+
 
 Author: Darren Conly
-Last Updated: 
+Last Updated: Oct 2026
 Updated by: 
 Copyright:   (c) SACOG
 Python Version: 3.x
 """
 
+import os
+import sys
+import json
 from pathlib import Path
+from time import perf_counter
+from multiprocessing import Pool
 
 import geopandas as gpd
 import pandas as pd
-import arcpy
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
 from shapely import wkt
 
+try:
+    import arcpy
+except ImportError:
+    arcpy = None # no ArcGIS Pro install; fc2parquet() still works through the pyogrio reader
+
+from esri_file_to_dataframe import iter_esri_chunks, _split_gdb_path
+
+# helper modules shared by several script folders (sql_session, polygon_cache, etc.)
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath('shared')))
+from polygon_cache import source_stats
+
+FINGERPRINT_KEY = 'fc2parquet_source'
+
+# arrow type for each ESRI field type
+ESRI_TO_ARROW_TYPES = {'OID': pa.int64(), 'SmallInteger': pa.int16(), 'Integer': pa.int32(),
+                       'BigInteger': pa.int64(), 'Single': pa.float32(), 'Double': pa.float64(),
+                       'String': pa.string(), 'Date': pa.timestamp('us'), 'GUID': pa.string(),
+                       'GlobalID': pa.string()}
+
+
+def reduce_geometry(gdf, method='centroid', tolerance=None):
+    """
+    Replaces geometry of gdf with a simpler geometry, computed for all features at once with
+    vectorized shapely functions. Can greatly reduce output size for large polygon layers.
+    method = one of:
+        'centroid' - centroid point. Can fall outside of irregularly-shaped polygons.
+        'point_on_surface' - point guaranteed to be within the polygon.
+        'bbox' - bounding box (envelope) polygon
+        'simplify' - original geometry simplified to within tolerance (topology preserved)
+    tolerance = simplification tolerance in CRS units. Required if method is 'simplify'.
+    """
+    geoms = gdf.geometry.values.to_numpy()
+
+    if method == 'centroid':
+        out_geoms = shapely.centroid(geoms)
+    elif method == 'point_on_surface':
+        out_geoms = shapely.point_on_surface(geoms)
+    elif method == 'bbox':
+        out_geoms = shapely.envelope(geoms)
+    elif method == 'simplify':
+        if not tolerance:
+            raise Exception("ERROR: geometry reduction method 'simplify' requires a tolerance value.")
+        out_geoms = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    else:
+        raise Exception(f"ERROR: geometry reduction method must be 'centroid', 'point_on_surface', 'bbox', or "
+                        f"'simplify'. '{method}' was given.")
+
+    return gdf.set_geometry(gpd.GeoSeries(out_geoms, index=gdf.index, crs=gdf.crs), crs=gdf.crs)
+
+
 def esri_to_df(esri_obj_path, include_geom, field_list=None, index_field=None, 
-               crs_val=None, dissolve=False, use_centroid=False):
+               crs_val=None, dissolve=False, use_centroid=False, geom_reduction=None, simplify_tolerance=None):
     """
     Converts ESRI file (File GDB table, SHP, or feature class) to either pandas dataframe
     or geopandas geodataframe (if it is spatial data)
@@ -32,6 +97,10 @@ def esri_to_df(esri_obj_path, include_geom, field_list=None, index_field=None,
     dissolve = True/False indicating if you want the resulting GDF to be dissolved to single feature.
     use_centroid = True/False indicating if you want to use centroid points rather than, for example, line for polygon geometry.
                     Setting to True can save a lot of space if working with a large number of records.
+                    Same as geom_reduction='centroid'.
+    geom_reduction = geometry reduction method applied after loading ('centroid', 'point_on_surface',
+                    'bbox', or 'simplify'). See reduce_geometry(). Optional.
+    simplify_tolerance = tolerance, in CRS units, if geom_reduction is 'simplify'.
     """
 
     fields = field_list # should not be necessary, but was having issues where class properties were getting changed with this formula
@@ -50,8 +119,6 @@ def esri_to_df(esri_obj_path, include_geom, field_list=None, index_field=None,
             rowlist = [i for i in row]
             if include_geom:
                 geom_wkt = wkt.loads(rowlist[fields.index(f_esrishp)].WKT)
-                if use_centroid:
-                    geom_wkt = geom_wkt.centroid
                 rowlist[fields.index(f_esrishp)] = geom_wkt
             out_row = rowlist
             data_rows.append(out_row)  
@@ -65,6 +132,11 @@ def esri_to_df(esri_obj_path, include_geom, field_list=None, index_field=None,
         # only set if the input file has no CRS--this is not same thing as .to_crs(), which merely projects to a CRS
         if crs_val: out_df.crs = crs_val
 
+        # reduce geometry for all features at once, rather than one shapely object at a time in the cursor loop
+        if use_centroid and not geom_reduction: geom_reduction = 'centroid'
+        if geom_reduction:
+            out_df = reduce_geometry(out_df, method=geom_reduction, tolerance=simplify_tolerance)
+
         # dissolve to single zone so that, during spatial join, points don't erroneously tag to 2 overlapping zones.
         if dissolve and out_df.shape[0] > 1: 
             out_df = out_df.dissolve() 
@@ -74,11 +146,266 @@ def esri_to_df(esri_obj_path, include_geom, field_list=None, index_field=None,
     return out_df
 
 
-def fc2parquet(in_fc, out_pqt, field_list, crs, convert_to_centroid=False):
-    gdf = esri_to_df(esri_obj_path=in_fc, field_list=field_list, include_geom=True, crs_val=crs,
-                     use_centroid=convert_to_centroid)
-    gdf.to_parquet(out_pqt)
+def _source_arrow_types(in_fc, field_list=None):
+    """
+    Returns {field name: arrow type} of in_fc's attribute fields, from the field types of the source rather than
+    from the values of any chunk. Types inferred from a chunk are unreliable, e.g. a field that is all null in
+    the first chunk would be typed null and fail on later chunks that have values.
+    """
+    if arcpy:
+        ftypes = {f.name: ESRI_TO_ARROW_TYPES.get(f.type, pa.string()) for f in arcpy.ListFields(in_fc)
+                  if f.type not in ('Geometry', 'Blob', 'Raster')}
+    else:
+        from pyogrio import read_info
+        data_path, layer = _split_gdb_path(in_fc)
+        info = read_info(data_path, layer=layer)
+        ftypes = {}
+        for fname, dtype in zip(info['fields'].tolist(), info['dtypes'].tolist()):
+            ftypes[fname] = pa.string() if dtype == 'object' else pa.from_numpy_dtype(dtype)
+
+    return {f: ftypes[f] for f in (field_list or ftypes.keys()) if f in ftypes}
+
+
+def _file_schema(tbl, source_types, dictionary_fields=None):
+    # schema of the output file: types of the first chunk's columns, replaced by source field types where known
+    fields = []
+    for fld in tbl.schema:
+        ftype = source_types.get(fld.name, fld.type)
+        if dictionary_fields and fld.name in dictionary_fields:
+            ftype = pa.dictionary(pa.int32(), ftype)
+        fields.append(pa.field(fld.name, ftype))
+
+    return pa.schema(fields)
+
+
+def _chunk_to_arrow(gdf, schema=None, write_bbox=True, dictionary_fields=None):
+    # converts geodataframe chunk to arrow table with WKB geometry column and, optionally,
+    # GeoParquet bbox covering column
+    geoms = gdf.geometry.values
+    tbl = pa.Table.from_pandas(pd.DataFrame(gdf.drop(columns=gdf.geometry.name)), preserve_index=False)
+
+    if dictionary_fields:
+        # store low-cardinality fields (e.g. land use types) as dictionary arrays so that they are
+        # dictionary-encoded in the file and read back as categoricals
+        for fname in dictionary_fields:
+            idx = tbl.schema.get_field_index(fname)
+            tbl = tbl.set_column(idx, fname, tbl[fname].dictionary_encode())
+
+    tbl = tbl.append_column('geometry', pa.array(shapely.to_wkb(geoms), type=pa.binary()))
+
+    if write_bbox:
+        bounds = shapely.bounds(geoms)
+        bbox_arr = pa.StructArray.from_arrays([pa.array(bounds[:, i]) for i in range(4)],
+                                              names=['xmin', 'ymin', 'xmax', 'ymax'])
+        tbl = tbl.append_column('bbox', bbox_arr)
+
+    if schema is not None:
+        tbl = tbl.cast(schema)
+
+    return tbl
+
+
+def _geo_metadata(crs, geom_types, total_bounds, write_bbox):
+    # GeoParquet 1.1 file metadata. https://geoparquet.org/releases/v1.1.0/
+    geo_col = {
+        'encoding': 'WKB',
+        'geometry_types': sorted(geom_types),
+        'crs': crs.to_json_dict() if crs else None,
+        'bbox': total_bounds
+    }
+    if write_bbox:
+        geo_col['covering'] = {'bbox': {bnd: ['bbox', bnd] for bnd in ['xmin', 'ymin', 'xmax', 'ymax']}}
+
+    return {'geo': json.dumps({'version': '1.1.0', 'primary_column': 'geometry', 'columns': {'geometry': geo_col}})}
+
+
+def fc2parquet(in_fc, out_pqt, field_list, crs, convert_to_centroid=False, row_group_rows=100_000,
+               compression='zstd', compression_level=None, dictionary_fields=None, write_bbox=True,
+               extra_metadata=None, geom_reduction=None, simplify_tolerance=None):
+    """
+    Streams ESRI feature class to GeoParquet file, one row group per chunk of rows read.
+    in_fc = path to ESRI feature class
+    out_pqt = output parquet file path
+    field_list = fields to include in output. If None, all fields are included.
+    crs = crs to apply to the output geometry
+    convert_to_centroid = True/False indicating if output geometry should be centroid points. Same as
+        geom_reduction='centroid'.
+    row_group_rows = number of rows in each row group. Also sets how many rows are held in memory at once.
+    compression = parquet compression codec, e.g. 'zstd', 'snappy', 'gzip', or None
+    compression_level = codec compression level. Optional.
+    dictionary_fields = list of low-cardinality fields (e.g. land use type) to dictionary-encode. If None,
+        uses the pyarrow default of trying dictionary encoding on all fields.
+    write_bbox = True/False indicating if GeoParquet bbox covering column should be added
+    extra_metadata = dict of additional key-value pairs to store in the parquet file metadata. Optional.
+    geom_reduction = 'centroid', 'point_on_surface', 'bbox', or 'simplify'. See reduce_geometry(). Optional.
+    simplify_tolerance = tolerance, in CRS units, if geom_reduction is 'simplify'.
+    """
+    if convert_to_centroid and not geom_reduction: geom_reduction = 'centroid'
+
+    writer = None
+    geom_types = set()
+    total_bounds = None
+    rows_written = 0
+    out_crs = None
+    source_types = _source_arrow_types(in_fc, field_list)
+
+    # written to temp file, which only replaces out_pqt once the whole conversion has succeeded. A failed run never
+    # leaves behind a partial file with a valid source fingerprint that later runs would treat as up to date.
+    tmp_pqt = f"{out_pqt}.{os.getpid()}.tmp"
+
+    try:
+        for chunk in iter_esri_chunks(in_fc, include_geom=True, chunk_rows=row_group_rows, field_list=field_list,
+                                      crs_val=crs):
+            if chunk.shape[0] == 0: continue
+            if geom_reduction:
+                chunk = reduce_geometry(chunk, method=geom_reduction, tolerance=simplify_tolerance)
+
+            if writer is None:
+                tbl = _chunk_to_arrow(chunk, write_bbox=write_bbox, dictionary_fields=dictionary_fields)
+                schema = _file_schema(tbl, source_types, dictionary_fields)
+                tbl = tbl.cast(schema)
+                use_dict = list(dictionary_fields) if dictionary_fields else True
+                writer = pq.ParquetWriter(tmp_pqt, schema, compression=compression, 
+                                          compression_level=compression_level, use_dictionary=use_dict,
+                                          write_statistics=True)
+                out_crs = chunk.crs
+            else:
+                tbl = _chunk_to_arrow(chunk, schema=writer.schema, write_bbox=write_bbox, 
+                                      dictionary_fields=dictionary_fields)
+
+            writer.write_table(tbl, row_group_size=row_group_rows)
+            rows_written += tbl.num_rows
+
+            # track overall geometry types and extent for the file-level GeoParquet metadata
+            geom_types.update(chunk.geom_type.dropna().unique())
+            cbounds = chunk.total_bounds.tolist()
+            if total_bounds is None:
+                total_bounds = cbounds
+            else:
+                total_bounds = [min(total_bounds[0], cbounds[0]), min(total_bounds[1], cbounds[1]),
+                                max(total_bounds[2], cbounds[2]), max(total_bounds[3], cbounds[3])]
+
+        if writer is not None:
+            file_meta = _geo_metadata(out_crs, geom_types, total_bounds, write_bbox)
+            if extra_metadata: file_meta.update(extra_metadata)
+            writer.add_key_value_metadata(file_meta)
+            writer.close()
+            os.replace(tmp_pqt, out_pqt)
+    except BaseException:
+        if writer is not None: writer.close()
+        Path(tmp_pqt).unlink(missing_ok=True)
+        raise
+
+    if writer is None:
+        raise Exception(f"ERROR: no features with geometry in {in_fc}. No parquet file created.")
+
+    return rows_written
+
+
+def source_fingerprint(in_fc, conversion_args):
+    """
+    Returns JSON string identifying the state of in_fc (path, size, modified time, schema) plus the
+    conversion settings used. Size and modified time are from polygon_cache.source_stats(): for a feature class
+    in a file GDB, the whole GDB folder; for a shapefile, all of its files (.dbf, .prj, etc.). Lock files are
+    left out, so opening the data in ArcGIS does not change the fingerprint.
+    """
+    data_path, layer = _split_gdb_path(in_fc)
+    src_size, src_mtime = source_stats(in_fc)
+
+    if arcpy:
+        schema = [[f.name, f.type] for f in arcpy.ListFields(in_fc)]
+    else:
+        from pyogrio import read_info
+        info = read_info(data_path, layer=layer)
+        schema = [[fname, dtype] for fname, dtype in zip(info['fields'].tolist(), info['dtypes'].tolist())]
+        schema.append(['geometry', info['geometry_type']])
+
+    fingerprint = {'path': str(in_fc), 'size': src_size, 'mtime': src_mtime, 'schema': schema,
+                   'conversion_args': conversion_args}
+
+    return json.dumps(fingerprint, sort_keys=True, default=str)
+
+
+def _stored_fingerprint(out_pqt):
+    # fingerprint stored in existing output file, or None if no usable output file
+    if not Path(out_pqt).exists():
+        return None
+    try:
+        file_meta = pq.read_metadata(out_pqt).metadata or {}
+    except Exception:
+        return None # e.g., not a parquet file
 
+    fp = file_meta.get(FINGERPRINT_KEY.encode())
+    return fp.decode() if fp else None
+
+
+def _peak_rss_mb():
+    # peak memory of the current process
+    if sys.platform == 'win32':
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / 1e6, 1)
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on linux, bytes on mac
+    return round(peak / 1e6 if sys.platform == 'darwin' else peak / 1e3, 1)
+
+
+def _convert_job(job):
+    # runs in worker process. Each worker only does one job (maxtasksperchild=1) so peak RSS is per-file.
+    in_fc, out_pqt, fingerprint, fc2pqt_kwargs = job
+    st = perf_counter()
+    nrows = fc2parquet(in_fc, out_pqt, extra_metadata={FINGERPRINT_KEY: fingerprint}, **fc2pqt_kwargs)
+    elapsed_sec = perf_counter() - st
+
+    return {'in_fc': in_fc, 'out_pqt': str(out_pqt), 'status': 'converted', 'rows': nrows,
+            'seconds': round(elapsed_sec, 1), 'rows_per_sec': round(nrows / max(elapsed_sec, 1e-6)),
+            'bytes_written': os.path.getsize(out_pqt), 'peak_rss_mb': _peak_rss_mb()}
+
+
+def batch_fc2parquet(input_fcs, output_folder, field_list=None, crs=None, workers=None, skip_unchanged=True,
+                     **fc2pqt_kwargs):
+    """
+    Converts multiple ESRI feature classes to parquet in parallel. Output files are named <fc name>.parquet.
+    input_fcs = list of feature class paths
+    output_folder = folder for output parquet files
+    field_list, crs = same as for fc2parquet()
+    workers = number of worker processes. If None, uses number of CPUs, up to the number of files to convert.
+    skip_unchanged = True/False. If True, inputs whose source fingerprint matches the fingerprint in the 
+        existing output file are not reconverted.
+    fc2pqt_kwargs = other arguments passed to fc2parquet(), e.g. geom_reduction, compression.
+
+    Returns list of dicts, one per input, with rows, rows/sec, bytes written, and peak memory of each conversion.
+    """
+    fc2pqt_kwargs = {'field_list': field_list, 'crs': crs, **fc2pqt_kwargs}
+
+    fc_names = [Path(fc).name for fc in input_fcs]
+    dupe_names = set([fcn for fcn in fc_names if fc_names.count(fcn) > 1])
+    if dupe_names:
+        raise Exception(f"ERROR: multiple input feature classes named {dupe_names} would write to the same parquet file.")
+
+    jobs = []
+    results = []
+    for fc in input_fcs:
+        out_pqt = Path(output_folder).joinpath(f"{Path(fc).name}.parquet")
+        fingerprint = source_fingerprint(fc, fc2pqt_kwargs)
+        if skip_unchanged and _stored_fingerprint(out_pqt) == fingerprint:
+            print(f"\t{Path(fc).name} unchanged since {out_pqt} was created. Skipping.")
+            results.append({'in_fc': fc, 'out_pqt': str(out_pqt), 'status': 'skipped'})
+            continue
+        jobs.append((fc, out_pqt, fingerprint, fc2pqt_kwargs))
+
+    if len(jobs) == 0:
+        return results
+
+    n_workers = min(workers or os.cpu_count(), len(jobs))
+    print(f"converting {len(jobs)} feature classes to parquet with {n_workers} workers...")
+    with Pool(processes=n_workers, maxtasksperchild=1) as pool:
+        for res in pool.imap_unordered(_convert_job, jobs):
+            print(f"\t{res['out_pqt']}: {res['rows']} rows in {res['seconds']} seconds ({res['rows_per_sec']} rows/sec), "
+                  f"{round(res['bytes_written'] / 1e6, 1)} MB written, peak RSS {res['peak_rss_mb']} MB")
+            results.append(res)
+
+    return results
 
 
 if __name__ == '__main__':
@@ -91,13 +418,11 @@ if __name__ == '__main__':
     output_folder = r'I:\Projects\Indrani\Pathways_Landuse_summaries_parquet'
 
     fields_to_load = None # ['ES_Landuse', 'HU', 'EMP', 'GROSS_NET', 'GISac']
-    load_as_centroid = True
+    geom_reduction = 'centroid' # 'centroid', 'point_on_surface', 'bbox', 'simplify', or None to keep full geometry
+    simplify_tol = None # tolerance in feet, only used if geom_reduction = 'simplify'
+    dict_encode_fields = None # ['ES_Landuse']
 
-    for fc in input_fcs:
-        fcname = Path(fc).name
-        print(f"converting {fcname} to parquet...")
-        out_pqt = Path(output_folder).joinpath(f"{fcname}.parquet")
-        fc2parquet(fc, out_pqt, field_list=fields_to_load, crs="EPSG:2226",
-                   convert_to_centroid=load_as_centroid)
-        print(f"Created parquet file {out_pqt}")
+    n_workers = 3
 
+    batch_fc2parquet(input_fcs, output_folder, workers=n_workers, field_list=fields_to_load, crs="EPSG:2226",
+                     geom_reduction=geom_reduction, simplify_tolerance=simplify_tol, dictionary_fields=dict_encode_fields)
@@ -0,0 +1,465 @@
+"""
+Name: link_node_tools.py
+Purpose: Vectorized numpy/shapely tools for building the DAYSIM link and node files from a street centerline
+    layer (see Create_Links_Nodes_full_v2.py and Split_Links_Analysis.py).
+
+    split_lines() splits every line longer than max_len into equal-length pieces in one pass. It replaces the
+    arcpy loop of random split points > buffer/select near endpoints > split line at points, which was repeated
+    until no line was left to split. Because each line is cut into equal pieces, no split point is ever closer than
+    max_len / 2 to the line's ends, so the old rule of not splitting within end_buffer of an endpoint (to avoid
+    slivers) always holds as long as max_len / 2 > end_buffer.
+
+    build_topology() gives each link a from and to node ID from its endpoint coordinates. Endpoints are snapped to
+    a grid of tolerance-sized cells, each cell's (x, y) cell index is packed into one int64 key, and node IDs come
+    from np.unique(keys, return_inverse=True). This replaces making "X_Y" text keys for each endpoint, dissolving
+    endpoint points on them, and looking up each link's From_X_Y/To_X_Y text in a dict of node IDs.
+
+    Grid snapping alone can split endpoints a hair apart that fall on either side of a cell edge into different
+    nodes. merge_nodes() then merges all nodes within a tolerance distance of each other, using a KD-tree to find
+    pairs of close nodes and union-find to group chains of close nodes into one node.
+
+    export_fc_table() writes chosen fields of a feature class, in the order given, to CSV, Parquet or Feather. Rows
+    are read in batches and streamed to a pyarrow writer, with no temp file and no second pass over the output.
+
+    derive_link_attrs() makes link attributes (speed, capacity, link type, etc.) for all links at once from a
+    rules file (e.g. link_attribute_rules.json), using array lookups on each link's class. Making a network with
+    different speeds or capacities only needs a different rules file.
+
+    Running this script directly runs an example on synthetic lines.
+
+
+Author: Darren Conly
+Last Updated: Oct 2026
+Updated by:
+Copyright:   (c) SACOG
+Python Version: 3.x
+"""
+import os
+import io
+import csv
+import json
+from itertools import islice
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import shapely
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None # only needed for merge_nodes()
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None # only needed for reading and writing ESRI feature classes
+
+OUT_FORMATS = ('csv', 'parquet', 'feather')
+METERS_PER_MILE = 1609.344
+
+# arrow type for each ESRI field type
+ESRI_TO_ARROW_TYPES = {'OID': pa.int64(), 'SmallInteger': pa.int16(), 'Integer': pa.int32(),
+                       'BigInteger': pa.int64(), 'Single': pa.float32(), 'Double': pa.float64(),
+                       'String': pa.string(), 'Date': pa.timestamp('us'), 'GUID': pa.string(),
+                       'GlobalID': pa.string()}
+
+
+def split_lines(lines, max_len=530, end_buffer=50):
+    """
+    Splits lines into pieces shorter than max_len. Each line of length L is split into floor(L / max_len) + 1
+    pieces of equal length. Lines already shorter than max_len are returned as-is.
+    lines = array of shapely LineStrings (multipart lines should be exploded first). Z values are dropped.
+    max_len = pieces are shorter than this, in CRS units
+    end_buffer = min distance from a split point to the line's ends, to avoid slivers (see module docstring)
+    Returns (array of line pieces, position in lines of the line each piece came from)
+    """
+    if max_len / 2 <= end_buffer:
+        raise Exception(f"ERROR: max_len must be more than twice end_buffer to avoid splitting within end_buffer " \
+                        f"of line ends. max_len = {max_len}, end_buffer = {end_buffer}.")
+
+    lines = np.asarray(lines, dtype=object)
+    if not (shapely.get_type_id(lines) == 1).all():
+        raise Exception("ERROR: all geometries must be single-part LineStrings. Explode multipart lines first.")
+
+    lengths = shapely.length(lines)
+    n_pieces = (np.floor(lengths / max_len) + 1).astype(np.int64)
+    piece_len = lengths / n_pieces
+    first_piece = np.concatenate([[0], np.cumsum(n_pieces)[:-1]]) # id of each line's first piece
+    src = np.repeat(np.arange(len(lines)), n_pieces)
+
+    # distance of each vertex along its line
+    coords, vtx_line = shapely.get_coordinates(lines, return_index=True)
+    seg_len = np.hypot(*np.diff(coords, axis=0).T)
+    seg_len[vtx_line[1:] != vtx_line[:-1]] = 0 # no segment between the last vertex of a line and first of the next
+    cum_len = np.concatenate([[0], np.cumsum(seg_len)])
+    line_start = np.concatenate([[0], np.flatnonzero(vtx_line[1:] != vtx_line[:-1]) + 1])
+    vtx_dist = cum_len - cum_len[line_start][vtx_line]
+
+    # each vertex goes in the piece its distance falls in. Zero-length lines (e.g. all vertices at one point) have
+    # piece_len 0 and are one piece.
+    vtx_piece_len = piece_len[vtx_line]
+    vtx_piece = np.divide(vtx_dist, vtx_piece_len, out=np.zeros_like(vtx_dist), where=vtx_piece_len > 0)
+    vtx_piece = np.minimum(np.floor(vtx_piece), n_pieces[vtx_line] - 1).astype(np.int64)
+
+    # split points, at distance k * piece_len for k = 1 ... n_pieces - 1. Each ends one piece and starts the next.
+    cut_line = np.repeat(np.arange(len(lines)), n_pieces - 1)
+    cut_k = np.arange(len(cut_line)) - np.repeat(first_piece - np.arange(len(lines)), n_pieces - 1) + 1
+    cut_dist = cut_k * piece_len[cut_line]
+    cut_xy = shapely.get_coordinates(shapely.line_interpolate_point(lines[cut_line], cut_dist))
+
+    # all points of all pieces, sorted into order by piece, then distance along line. Split points come last in
+    # the piece they end and first in the piece they start.
+    piece_id = np.concatenate([first_piece[vtx_line] + vtx_piece, first_piece[cut_line] + cut_k - 1,
+                               first_piece[cut_line] + cut_k])
+    dist = np.concatenate([vtx_dist, cut_dist, cut_dist])
+    order = np.concatenate([np.ones(len(vtx_dist)), np.full(len(cut_dist), 2), np.zeros(len(cut_dist))])
+    xy = np.concatenate([coords, cut_xy, cut_xy])
+
+    sort_idx = np.lexsort((order, dist, piece_id))
+    pieces = shapely.linestrings(xy[sort_idx], indices=piece_id[sort_idx])
+
+    return pieces, src
+
+
+def split_links_fc(in_fc, out_fc, where_clause=None, max_len=530, end_buffer=50):
+    """
+    Makes out_fc with lines of in_fc split into pieces shorter than max_len (see split_lines()). Each piece
+    keeps all attributes of the line it came from.
+    where_clause = SQL filter of in_fc lines to include, e.g. to leave out highways and ramps. Optional.
+    """
+    start_time = perf_counter()
+    in_meta = arcpy.Describe(in_fc)
+    arcpy.management.CreateFeatureclass(os.path.dirname(out_fc), os.path.basename(out_fc), geometry_type='POLYLINE',
+                                        template=in_fc, spatial_reference=in_meta.spatialReference)
+
+    attr_fields = [f.name for f in arcpy.ListFields(out_fc) if f.editable and f.type not in ('OID', 'Geometry')]
+    cur_fields = attr_fields + ['SHAPE@WKB']
+    with arcpy.da.SearchCursor(in_fc, field_names=cur_fields, where_clause=where_clause) as scur:
+        rows = [row for row in scur if row[-1] is not None]
+
+    in_rows = [row[:-1] for row in rows]
+    geoms = shapely.from_wkb([row[-1] for row in rows])
+
+    # multipart lines are split into their parts first; each part keeps the line's attributes
+    parts, part_src = shapely.get_parts(geoms, return_index=True)
+    pieces, piece_src = split_lines(parts, max_len=max_len, end_buffer=end_buffer)
+    row_src = part_src[piece_src]
+
+    with arcpy.da.InsertCursor(out_fc, field_names=cur_fields) as inscur:
+        for row_idx, wkb in zip(row_src, shapely.to_wkb(pieces)):
+            inscur.insertRow(in_rows[row_idx] + (wkb,))
+
+    et_sec = round(perf_counter() - start_time, 1)
+    print(f"Split {len(in_rows)} lines into {len(pieces)} pieces shorter than {max_len} in {et_sec} seconds.")
+
+    return out_fc
+
+
+def line_endpoints(lines):
+    # returns (start x/y array, end x/y array) of lines, each with shape (number of lines, 2)
+    coords, line_idx = shapely.get_coordinates(lines, return_index=True)
+    n_vtx = np.bincount(line_idx, minlength=len(lines))
+    last_vtx = np.cumsum(n_vtx) - 1
+
+    return coords[last_vtx - n_vtx + 1], coords[last_vtx]
+
+
+def build_topology(start_xy, end_xy, tolerance=1.0):
+    """
+    Assigns node IDs to link endpoints. Endpoints in the same tolerance x tolerance grid cell are the same node.
+    With tolerance=1, this is the same as the old int(x)_int(y) text keys, for positive coordinates. Points that
+    are within tolerance of each other but in neighboring cells get different nodes (use merge_nodes() to merge
+    them).
+    start_xy, end_xy = arrays of link start and end x/y, each with shape (number of links, 2)
+    tolerance = grid cell size, in CRS units
+    Returns (from node ID of each link, to node ID of each link, x/y of each node). Node IDs start at 1, and
+    node n's x/y is node_xy[n - 1], the first link endpoint found in its cell.
+    """
+    end_pts = np.concatenate([np.asarray(start_xy, dtype=float), np.asarray(end_xy, dtype=float)]).reshape(-1, 2)
+    if len(end_pts) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), end_pts
+
+    cells = np.floor(end_pts / tolerance).astype(np.int64)
+    cells -= cells.min(axis=0)
+
+    # pack (x cell, y cell) into one int64 key
+    y_span = int(cells[:, 1].max()) + 1
+    if (int(cells[:, 0].max()) + 1) * y_span >= 2**63:
+        raise Exception(f"ERROR: too many grid cells to pack into int64 keys with tolerance = {tolerance}. " \
+                        f"Use a larger tolerance.")
+    keys = cells[:, 0] * y_span + cells[:, 1]
+
+    _, first_idx, node_idx = np.unique(keys, return_index=True, return_inverse=True)
+    node_ids = node_idx.ravel() + 1
+    n_links = len(end_pts) // 2
+
+    return node_ids[:n_links], node_ids[n_links:], end_pts[first_idx]
+
+
+def merge_nodes(node_xy, tolerance):
+    """
+    Merges nodes that are within tolerance of each other, including chains of nodes that are each within
+    tolerance of the next. Each merged node is at the mean x/y of the nodes merged into it.
+    node_xy = x/y of each node, with shape (number of nodes, 2). Node n is node_xy[n - 1].
+    tolerance = max distance between nodes to merge, in CRS units
+    Returns (new node ID of each old node, x/y of each new node, dict of merge stats). New node IDs start at 1
+        and are in order of the lowest old node ID merged into them.
+    """
+    if cKDTree is None:
+        raise Exception("ERROR: merging nodes needs scipy. Install scipy, or set merge tolerance to None.")
+
+    n_nodes = len(node_xy)
+    pairs = cKDTree(node_xy).query_pairs(r=tolerance, output_type='ndarray')
+
+    # union-find: each node points to the lowest node ID it is linked to, with path halving, until no pointer changes
+    parent = np.arange(n_nodes)
+    while True:
+        root_i, root_j = parent[pairs[:, 0]], parent[pairs[:, 1]]
+        low = np.minimum(root_i, root_j)
+        new_parent = parent.copy()
+        np.minimum.at(new_parent, root_i, low)
+        np.minimum.at(new_parent, root_j, low)
+        new_parent = new_parent[new_parent]
+        if np.array_equal(new_parent, parent): break
+        parent = new_parent
+
+    roots, node_map = np.unique(parent, return_inverse=True)
+    cluster_size = np.bincount(node_map)
+    merged_xy = np.column_stack([np.bincount(node_map, weights=node_xy[:, i]) / cluster_size for i in (0, 1)])
+    spread = np.hypot(*(node_xy - merged_xy[node_map]).T)
+
+    stats = {'nodes_in': n_nodes, 'nodes_out': len(roots), 'close_pairs': len(pairs),
+             'merged_nodes': int(cluster_size[cluster_size > 1].sum()), 'clusters': int((cluster_size > 1).sum()),
+             'max_cluster_size': int(cluster_size.max()) if n_nodes else 0,
+             'max_move': float(spread.max()) if n_nodes else 0.0}
+
+    return node_map + 1, merged_xy, stats
+
+
+def read_lines(fc, field_list=()):
+    """
+    Reads lines of fc. Rows with no geometry are skipped.
+    field_list = attribute fields to read, in addition to object ID and geometry
+    Returns (array of object IDs, dict of {field: array of values}, array of shapely lines)
+    """
+    with arcpy.da.SearchCursor(fc, field_names=['OID@', *field_list, 'SHAPE@WKB']) as scur:
+        rows = [row for row in scur if row[-1] is not None]
+
+    cols = list(zip(*rows)) if rows else [()] * (len(field_list) + 2)
+    attrs = {fname: np.array(col) for fname, col in zip(field_list, cols[1:-1])}
+
+    return np.array(cols[0]), attrs, shapely.from_wkb(cols[-1])
+
+
+def lines_topology(lines, tolerance=1.0, merge_tolerance=None):
+    """
+    Assigns from and to node IDs to each line (see build_topology()). Multipart lines use the first and last point
+    of all their parts.
+    merge_tolerance = if given, also merges nodes within this distance of each other (see merge_nodes()). Optional.
+    Returns (from node ID of each line, to node ID of each line, x/y of each node)
+    """
+    from_node, to_node, node_xy = build_topology(*line_endpoints(lines), tolerance=tolerance)
+
+    if merge_tolerance:
+        node_map, node_xy, stats = merge_nodes(node_xy, merge_tolerance)
+        from_node, to_node = node_map[from_node - 1], node_map[to_node - 1]
+        stats['links_same_from_to'] = int((from_node == to_node).sum()) # links shorter than merge_tolerance
+        print(f"Merged nodes within {merge_tolerance} of each other: {stats}")
+
+    return from_node, to_node, node_xy
+
+
+def link_topology(link_fc, tolerance=1.0, merge_tolerance=None):
+    """
+    Reads endpoints of link_fc lines and assigns from and to node IDs to each link (see lines_topology()).
+    Returns (object ID of each link, from node ID of each link, to node ID of each link, x/y of each node)
+    """
+    start_time = perf_counter()
+    oids, _, lines = read_lines(link_fc)
+    from_node, to_node, node_xy = lines_topology(lines, tolerance=tolerance, merge_tolerance=merge_tolerance)
+
+    et_sec = round(perf_counter() - start_time, 1)
+    print(f"Built topology of {len(oids)} links and {len(node_xy)} nodes in {et_sec} seconds.")
+
+    return oids, from_node, to_node, node_xy
+
+
+def load_link_rules(rules_path):
+    """
+    Loads link attribute rules from a JSON file (see link_attribute_rules.json), with keys:
+        class_field = input link field with each link's class, e.g. 'CLASS'
+        class_values = {output field: {class: value}}. Key '_default' is the value for classes not listed.
+        copy_fields = {output field: input link field to copy it from}. Optional.
+        constants = {output field: value for all links}. Optional.
+    """
+    with open(rules_path) as f:
+        rules = json.load(f)
+
+    if 'class_field' not in rules:
+        raise Exception(f"ERROR: {rules_path} has no class_field.")
+    for out_field, class_map in rules.get('class_values', {}).items():
+        if '_default' not in class_map:
+            raise Exception(f"ERROR: class_values for {out_field} in {rules_path} has no '_default' value.")
+
+    return rules
+
+
+def rules_input_fields(rules):
+    # input link fields the rules need
+    return [rules['class_field'], *[f for f in rules.get('copy_fields', {}).values() if f != rules['class_field']]]
+
+
+def derive_link_attrs(link_attrs, rules):
+    """
+    Makes link attributes for all links at once from rules (see load_link_rules()).
+    link_attrs = dict of {input link field: array of values}, with the fields from rules_input_fields(rules)
+    Returns dict of {output field: array of values}
+    """
+    out_attrs = {}
+    classes = np.asarray(link_attrs[rules['class_field']], dtype=object)
+    n_links = len(classes)
+
+    # class lookups: each link's position in the list of classes with rules, or the default's position if not listed
+    for out_field, class_map in rules.get('class_values', {}).items():
+        class_keys = [k for k in class_map if k != '_default']
+        class_vals = np.array([class_map[k] for k in class_keys] + [class_map['_default']])
+        pos = pd.Index(class_keys, dtype=object).get_indexer(classes)
+        pos[pos == -1] = len(class_keys)
+        out_attrs[out_field] = class_vals[pos]
+
+    for out_field, in_field in rules.get('copy_fields', {}).items():
+        out_attrs[out_field] = np.asarray(link_attrs[in_field])
+
+    for out_field, val in rules.get('constants', {}).items():
+        out_attrs[out_field] = np.full(n_links, val)
+
+    return out_attrs
+
+
+def lengths_in_miles(lines, meters_per_unit):
+    # planar length of each line, in miles. meters_per_unit = meters per CRS unit, e.g. 0.3048006 for US feet
+    return shapely.length(lines) * meters_per_unit / METERS_PER_MILE
+
+
+class TableWriter:
+    """
+    Streams record batches to a CSV, Parquet or Feather (arrow IPC) file.
+    out_path = output file
+    schema = pyarrow schema of the output
+    out_format = 'csv', 'parquet' or 'feather'
+    Use as context manager: with TableWriter(...) as writer: writer.write_batch(batch)
+
+    CSVs are written in the same layout as the csv module's default writer: header and values unquoted,
+    except for values containing a comma, quote or line break.
+    """
+    def __init__(self, out_path, schema, out_format='csv'):
+        if out_format not in OUT_FORMATS:
+            raise Exception(f"ERROR: out_format must be one of {OUT_FORMATS}. '{out_format}' was given.")
+
+        self.out_format = out_format
+        if out_format == 'csv':
+            self.writer = open(out_path, 'wb')
+            self._write_csv_rows([schema.names])
+        elif out_format == 'parquet':
+            self.writer = pq.ParquetWriter(out_path, schema)
+        else:
+            self.writer = pa.ipc.new_file(out_path, schema) # Feather v2 is the arrow IPC file format
+
+    def _write_csv_rows(self, rows):
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        self.writer.write(buf.getvalue().encode('utf-8'))
+
+    def write_batch(self, batch):
+        if self.out_format != 'csv':
+            self.writer.write_batch(batch)
+            return
+
+        buf = io.BytesIO()
+        try:
+            pa_csv.write_csv(batch, buf,
+                             write_options=pa_csv.WriteOptions(include_header=False, quoting_style='none', eol='\r\n'))
+            self.writer.write(buf.getvalue())
+        except pa.ArrowInvalid:
+            # batch has values that need quoting, which arrow's writer can only do by quoting every string
+            cols = [['' if v is None else v for v in col.to_pylist()] for col in batch.columns]
+            self._write_csv_rows(zip(*cols))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.writer.close()
+
+
+def write_columns(columns, out_path, out_format='csv'):
+    """
+    Writes columns to out_path.
+    columns = dict of {field name: array of values}, in the order fields are to be written
+    out_format = 'csv', 'parquet' or 'feather'
+    """
+    tbl = pa.table({fname: pa.array(vals) for fname, vals in columns.items()})
+    with TableWriter(out_path, tbl.schema, out_format) as writer:
+        for batch in tbl.to_batches():
+            writer.write_batch(batch)
+
+
+def export_fc_table(fc, field_list, out_path, out_format='csv', batch_rows=100_000):
+    """
+    Writes fields of fc to out_path, in the order of field_list. No object ID field is written unless it is in
+    field_list.
+    out_format = 'csv', 'parquet' or 'feather'
+    batch_rows = number of rows read and written at a time
+    """
+    start_time = perf_counter()
+    ftypes = {f.name: f.type for f in arcpy.ListFields(fc)}
+    missing = [f for f in field_list if f not in ftypes]
+    if missing:
+        raise Exception(f"ERROR: fields {missing} not found in {fc}.")
+    schema = pa.schema([(f, ESRI_TO_ARROW_TYPES.get(ftypes[f], pa.string())) for f in field_list])
+
+    n_rows = 0
+    with arcpy.da.SearchCursor(fc, field_names=field_list) as scur, \
+            TableWriter(out_path, schema, out_format) as writer:
+        while True:
+            rows = list(islice(scur, batch_rows))
+            if not rows: break
+
+            cols = zip(*rows)
+            writer.write_batch(pa.record_batch([pa.array(col, type=ftype) for col, ftype in zip(cols, schema.types)],
+                                               schema=schema))
+            n_rows += len(rows)
+
+    et_sec = round(perf_counter() - start_time, 1)
+    print(f"Wrote {n_rows} rows to {out_path} in {et_sec} seconds.")
+
+    return out_path
+
+
+if __name__ == '__main__':
+    # example: random street-like polylines, some much longer than max_len
+    rng = np.random.default_rng(0)
+    n_lines = 200_000
+    n_vtx = rng.integers(2, 12, n_lines)
+    steps = rng.normal(0, 120, (n_vtx.sum(), 2))
+    line_idx = np.repeat(np.arange(n_lines), n_vtx)
+    test_lines = shapely.linestrings(np.cumsum(steps, axis=0), indices=line_idx)
+
+    st = perf_counter()
+    test_pieces, test_src = split_lines(test_lines)
+    print(f"{n_lines} lines split into {len(test_pieces)} pieces in {round(perf_counter() - st, 2)} seconds")
+
+    piece_lengths = shapely.length(test_pieces)
+    assert piece_lengths.max() < 530
+    assert np.allclose(np.bincount(test_src, weights=piece_lengths), shapely.length(test_lines))
+
+    # zero-length and degenerate lines are kept as one piece, without stopping the other lines from being split
+    bad_lines = [shapely.LineString([(5, 5), (5, 5)]), shapely.LineString([(0, 0), (1200, 0)]),
+                 shapely.LineString([(3, 3), (3, 3), (3, 3)])]
+    bad_pieces, bad_src = split_lines(bad_lines)
+    assert bad_src.tolist() == [0, 1, 1, 1, 2]
+    assert np.allclose(shapely.length(bad_pieces), [0, 400, 400, 400, 0])
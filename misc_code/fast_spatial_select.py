@@ -3,58 +3,140 @@ Name: fast_spatial_select.py
 Purpose: Selects features from one feature class based on spatial relationship to other feature class
     E.g., selecting all parcels in some polygon-based area.
 
-    It's much faster than arcpy's SelectByLocation method, but does not have option for "have their center in" selection
+    It's much faster than arcpy's SelectByLocation method. The input features are read once, all selection
+    features are checked against them at once with a shapely STRtree spatial index, and features selected by
+    more than one (e.g. overlapping) selection feature are only written once.
 
-    Planned improvement: enable search distance or buffering around the selection feature (currently not available)
+    Supports a search distance (buffer) around the selection features, and the "have their center in" relationship.
+
+    For very large, highly-vertexed selection polygons (e.g. county boundary), set tile_max_vertices to split the
+    selection polygons into small tiles first (see polygon_tiling.py).
 
 
 Author: Darren Conly
-Last Updated: Apr 2025
-Updated by: 
+Last Updated: Oct 2026
+Updated by:
 Copyright:   (c) SACOG
 Python Version: 3.x
 """
 import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import shapely
 import arcpy
 
+# helper modules shared by several script folders (sql_session, polygon_cache, etc.)
+sys.path.append(str(Path(__file__).resolve().parents[1].joinpath('shared')))
+from polygon_tiling import query_tiled
+
+# {ESRI relationship name: (shapely predicate for STRtree.query(selection geoms), use feature center instead of geometry)}
+# STRtree.query(selection geoms, predicate) tests <selection geom> <predicate> <input feature>, so e.g.
+# input features WITHIN the selection feature is the 'covers' predicate.
+RELATIONSHIPS = {
+    'INTERSECT': ('intersects', False),
+    'INTERSECTS': ('intersects', False),
+    'WITHIN': ('covers', False),
+    'COMPLETELY_WITHIN': ('contains_properly', False),
+    'CONTAINS': ('covered_by', False),
+    'COMPLETELY_CONTAINS': ('within', False),
+    'HAVE_THEIR_CENTER_IN': ('intersects', True)
+}
+
+# shapely type ids of LineString, LinearRing and MultiLineString
+LINE_TYPE_IDS = [1, 2, 5]
+
+
+def feature_centers(geoms):
+    # center of each feature, as ArcGIS uses it for HAVE_THEIR_CENTER_IN: the point halfway along the line for
+    # lines (the centroid of a curved line can be far off the line), and the centroid for points and polygons
+    geoms = np.asarray(geoms)
+    centers = shapely.centroid(geoms)
+    is_line = np.isin(shapely.get_type_id(geoms), LINE_TYPE_IDS)
+    centers[is_line] = shapely.line_interpolate_point(geoms[is_line], 0.5, normalized=True)
+
+    return centers
+
+
+def select_indices(input_geoms, selection_geoms, select_relationship='INTERSECTS', search_distance=None,
+                   tile_max_vertices=None):
+    """
+    Returns sorted array of positions of input_geoms that have select_relationship with any of selection_geoms.
+    input_geoms, selection_geoms = arrays of shapely geometries in the same CRS
+    select_relationship = one of the keys in RELATIONSHIPS (same names as arcpy SelectLayerByLocation)
+    search_distance = distance, in CRS units, to buffer selection_geoms by before selecting. Optional.
+    tile_max_vertices = if specified, selection_geoms are split into tiles with no more than this many vertices
+        before selecting. Much faster if selection_geoms are few, very large polygons. Optional.
+    """
+    rel = select_relationship.upper()
+    if rel not in RELATIONSHIPS:
+        raise Exception(f"ERROR: select_relationship must be one of {list(RELATIONSHIPS.keys())}. " \
+                        f"'{select_relationship}' was given.")
+    predicate, use_center = RELATIONSHIPS[rel]
+
+    if search_distance:
+        selection_geoms = shapely.buffer(selection_geoms, search_distance)
+
+    if use_center:
+        input_geoms = feature_centers(input_geoms)
+
+    # one bulk query for all selection geometries. Returns 2 x N array of [selection geom position, input geom position]
+    if tile_max_vertices:
+        hits = query_tiled(input_geoms, selection_geoms, predicate=predicate, max_vertices=tile_max_vertices)
+    else:
+        tree = shapely.STRtree(input_geoms)
+        hits = tree.query(selection_geoms, predicate=predicate)
+
+    # features selected by more than one selection geometry only get returned once
+    return np.unique(hits[1])
+
+
 def fast_spatial_select(input_features, selection_features, out_gdb, out_fc_name,
-                        select_relationship='INTERSECTS'):
+                        select_relationship='INTERSECTS', search_distance=None, tile_max_vertices=None):
     """
-    Creates feature class that is subset of input_features that intersect
+    Creates feature class that is subset of input_features that have select_relationship with
      selection_features. Is a much faster (6-8x faster) version of arcpy SelectLayerByLocation.
-     NOTE - Cannot select based on "has their center in" relationship, NOR can you add a buffer around the selection feature.
+     select_relationship = 'INTERSECTS', 'WITHIN', 'COMPLETELY_WITHIN', 'CONTAINS', 'COMPLETELY_CONTAINS', or
+        'HAVE_THEIR_CENTER_IN'
+     search_distance = distance, in units of input_features' spatial reference, to buffer selection features by. Optional.
+     tile_max_vertices = max vertices per tile if selection features should be tiled first. Recommended (e.g. 200)
+        if selection features are a few very large polygons. Optional.
     """
-        
+
     pcl_meta = arcpy.Describe(input_features)
     out_fc_path = os.path.join(out_gdb, out_fc_name)
     arcpy.management.CreateFeatureclass(out_gdb, out_fc_name, template=input_features,
                                         geometry_type=pcl_meta.shapeType.upper(),
                                         spatial_reference=pcl_meta.spatialReference)
-    
-    polys = []
-    with arcpy.da.SearchCursor(selection_features, field_names=['SHAPE@']) as pcur:
-        for row in pcur:
-            polys.append(row[0])
+
+    # selection features are projected to the input features' spatial reference as they are read
+    with arcpy.da.SearchCursor(selection_features, field_names=['SHAPE@WKB'],
+                               spatial_reference=pcl_meta.spatialReference) as pcur:
+        polys = shapely.from_wkb([row[0] for row in pcur])
 
     if len(polys) == 0:
         raise Exception(f"ERROR: no features in {selection_features}")
 
-    inscur = arcpy.da.InsertCursor(out_fc_path, field_names="*")
+    # read all input features once. Geometry is read as WKB so that it can be loaded into shapely in one call.
+    pcl_fnames = [f.name for f in arcpy.ListFields(out_fc_path) if f.editable and f.type not in ('OID', 'Geometry')]
+    cur_fields = pcl_fnames + ['SHAPE@WKB']
+    with arcpy.da.SearchCursor(input_features, field_names=cur_fields) as scur:
+        in_rows = [row for row in scur if row[-1] is not None]
+
+    in_geoms = shapely.from_wkb([row[-1] for row in in_rows])
+    sel_idx = select_indices(in_geoms, polys, select_relationship=select_relationship,
+                             search_distance=search_distance, tile_max_vertices=tile_max_vertices)
+
+    with arcpy.da.InsertCursor(out_fc_path, field_names=cur_fields) as inscur:
+        for i in sel_idx:
+            inscur.insertRow(in_rows[i])
 
-    pcl_fnames = [f.name for f in arcpy.ListFields(out_fc_path)] # needed to ensure correct order of attributes for insert cursor
-    for selection_poly in polys:
-        with arcpy.da.SearchCursor(input_features, field_names=pcl_fnames,
-                                   spatial_filter=selection_poly,
-                                   spatial_relationship=select_relationship) as scur:
-            for row in scur:
-                try:
-                    inscur.insertRow(row)   
-                except:
-                    import pdb; pdb.set_trace()
+    print(f"{len(sel_idx)} of {len(in_rows)} features from {input_features} selected into {out_fc_path}")
 
-    return out_fc_path   
+    return out_fc_path
 
 
 
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    pass
@@ -6,26 +6,155 @@ Purpose:
     -Normally this is easy to do with an attribute join in the arcgis interface, but for large files (e.g. parcel file)
     a normal join or field calculation can take a long time (hours in some cases). Using SearchCursor(), this script does
     it much faster
+    -Join keys can be composite (multiple fields). If the join table has more than one row per key, the rows
+    can be aggregated (sum, mean, first, count) before joining, rather than the last row for each key winning.
+
+    Join keys and values are read as whole columns, key data types are made to match once per column,
+    and target rows are matched to join rows with a pandas hash index (Index.get_indexer) rather than
+    per-row lookups.
 
     ROADMAP: ideally this schould be turned into an arc toolbox
         
           
 Author: Darren Conly
-Last Updated: Dec 2021
+Last Updated: Oct 2026
 Updated by: <name>
 Copyright:   (c) SACOG
 Python Version: 3.x
 """
 
 from time import perf_counter
+
+import numpy as np
+import pandas as pd
 from arcpy import env, ListFields, management
 from arcpy.da import SearchCursor, UpdateCursor
 
+AGG_FUNCS = ('sum', 'mean', 'first', 'count')
+
+# esri field types for fields added to the target table, where the aggregation changes the data type
+AGG_FIELD_TYPES = {'mean': 'DOUBLE', 'count': 'LONG'}
 
-def fast_join(fc_target, fc_target_keyfield, fc_join, fc_join_keyfield, fields_to_join):
+
+def read_columns(fc, field_names):
+    # reads fields from table as dict of {field name: numpy object array}. Object arrays keep the
+    # original python values (including None) so they can be written back out unchanged.
+    with SearchCursor(fc, field_names) as cur:
+        columns = list(zip(*cur))
+    if not columns: # empty table
+        columns = [()] * len(field_names)
+
+    return {fname: np.array(col, dtype=object) for fname, col in zip(field_names, columns)}
+
+
+def key_kind(keys):
+    # 'num' or 'str', based on the non-null key values
+    inferred = pd.api.types.infer_dtype(keys, skipna=True)
+    if inferred in ('integer', 'floating', 'mixed-integer-float', 'decimal'): return 'num'
+    return 'str'
+
+
+def coerce_keys(keys, to_kind):
+    """
+    Converts whole key array to to_kind ('num' or 'str') as pandas Index, so that keys from tables with
+    differing key field types (e.g. text vs. long integer parcel IDs) match. Keys that can't be converted become null.
+    """
+    from_kind = key_kind(keys)
+    skeys = pd.Series(keys, dtype=object)
+    if from_kind == 'str' and to_kind == 'str':
+        return pd.Index(skeys.astype('string'))
+
+    num_keys = pd.to_numeric(skeys, errors='coerce').astype('Float64')
+    if to_kind == 'num':
+        return pd.Index(num_keys)
+
+    # numeric to text. Whole-number floats (e.g. 1234.0) convert to '1234', not '1234.0'
+    if (num_keys.dropna() % 1 == 0).all():
+        num_keys = num_keys.astype('Int64')
+    return pd.Index(num_keys.astype('string'))
+
+
+def build_key_index(key_cols, kinds):
+    """
+    Makes pandas Index (or MultiIndex, for composite keys) from list of key arrays, with each key array
+    coerced to its kind in kinds. Also returns boolean array flagging rows where any part of the key is null.
+    """
+    key_levels = [coerce_keys(keys, kind) for keys, kind in zip(key_cols, kinds)]
+    has_null = np.any([lvl.isna() for lvl in key_levels], axis=0)
+    if len(key_levels) == 1:
+        return key_levels[0], has_null
+
+    return pd.MultiIndex.from_arrays(key_levels), has_null
+
+
+def prep_join_table(join_data, key_fields, fields_to_join, agg_func=None):
+    """
+    Reduces join table to one row per unique key value. Returns key index, dict of {field: value array} aligned
+    with the key index, and index of key values that were in the join table more than once.
+    agg_func = None to use the last row for each duplicated key. Otherwise, how to aggregate values for each key:
+        'sum', 'mean', 'first' (first non-null value), or 'count' (number of non-null values), or a dict of
+        {field: agg function} to aggregate each field differently.
+    """
+    kinds = [key_kind(join_data[f]) for f in key_fields]
+    key_idx, has_null = build_key_index([join_data[f] for f in key_fields], kinds)
+    key_idx = key_idx[~has_null]
+    join_vals = {f: join_data[f][~has_null] for f in fields_to_join}
+
+    dupe_keys = key_idx[key_idx.duplicated(keep='first')].unique()
+
+    if agg_func is None:
+        # keep last occurrence of each duplicated key, consistent with a dict overwritten row by row
+        keep = ~key_idx.duplicated(keep='last')
+        return key_idx[keep], {f: vals[keep] for f, vals in join_vals.items()}, dupe_keys
+
+    aggs = agg_func if isinstance(agg_func, dict) else {f: agg_func for f in fields_to_join}
+    bad_aggs = {f: func for f, func in aggs.items() if func not in AGG_FUNCS}
+    if bad_aggs:
+        raise Exception(f"ERROR: aggregation functions {bad_aggs} not supported. Use one of {AGG_FUNCS}.")
+    no_agg = [f for f in fields_to_join if f not in aggs]
+    if no_agg:
+        raise Exception(f"ERROR: no aggregation function specified for fields {no_agg}.")
+
+    agg_df = pd.DataFrame(join_vals, index=pd.RangeIndex(len(key_idx)))
+    for f, func in aggs.items():
+        if func in ('sum', 'mean'): agg_df[f] = pd.to_numeric(agg_df[f], errors='coerce')
+
+    # one vectorized groupby on the integer codes of the (possibly composite) key
+    key_codes, unique_keys = pd.factorize(key_idx)
+    grouped = agg_df.groupby(key_codes, sort=True)
+
+    agg_vals = {}
+    for f, func in aggs.items():
+        # min_count=1 so that a key with only null values sums to null rather than 0
+        fvals = grouped[f].sum(min_count=1) if func == 'sum' else getattr(grouped[f], func)()
+
+        # nulls back to None so they are written as nulls by the update cursor
+        agg_vals[f] = fvals.astype(object).where(fvals.notna(), None).to_numpy()
+
+    # keys in group order, taken from the groups themselves so that it also works with no fields to join
+    return unique_keys[grouped.size().index], agg_vals, dupe_keys
+
+
+def fast_join(fc_target, fc_target_keyfield, fc_join, fc_join_keyfield, fields_to_join, agg_func=None):
+    """
+    Joins fields_to_join from fc_join onto fc_target.
+    fc_target_keyfield, fc_join_keyfield = key field name, or list of field names for a composite key. 
+        Composite key fields are matched in the order given.
+    agg_func = None for a one-to-one join (if fc_join has duplicate keys, the last row for each key is used).
+        For a many-to-one join, how to aggregate fc_join rows with the same key: 'sum', 'mean', 'first', 'count',
+        or a dict of {field: agg function}.
+    """
 
     start_time = perf_counter()
 
+    tkey_fields = [fc_target_keyfield] if isinstance(fc_target_keyfield, str) else list(fc_target_keyfield)
+    jkey_fields = [fc_join_keyfield] if isinstance(fc_join_keyfield, str) else list(fc_join_keyfield)
+    if len(tkey_fields) != len(jkey_fields):
+        raise Exception(f"ERROR: target key fields {tkey_fields} and join key fields {jkey_fields} " \
+            "must have the same number of fields.")
+
+    aggs = agg_func if isinstance(agg_func, dict) else {f: agg_func for f in fields_to_join}
+
     # make field dict for join fc fields {fname: [dtype, len]}
     jfields_names = [f.name for f in ListFields(fc_join)]
     jfields_dtypes = [f.type for f in ListFields(fc_join)]
@@ -40,7 +169,7 @@ def fast_join(fc_target, fc_target_keyfield, fc_join, fc_join_keyfield, fields_t
     print(f"Adding fields {fields_to_join} to target table {fc_target}...")
     for jfield in fields_to_join:
         if jfield not in target_start_fields:
-            ftype = jfields_dict[jfield][0]
+            ftype = AGG_FIELD_TYPES.get(aggs.get(jfield), jfields_dict[jfield][0])
             flen = jfields_dict[jfield][1]
             
             management.AddField(in_table=fc_target, field_name=jfield,
@@ -49,49 +178,50 @@ def fast_join(fc_target, fc_target_keyfield, fc_join, fc_join_keyfield, fields_t
             print(f"\t{jfield} already in {fc_target}'s fields. Will be OVERWRITTEN with joined data...")
 
 
-    join_cur_fields = [fc_join_keyfield] + fields_to_join
-    
-    
-    join_dict = {}
     print("reading data from join table...")
-    with SearchCursor(fc_join, join_cur_fields) as scur:
-        for i, row in enumerate(scur):
-            jkey = row[join_cur_fields.index(fc_join_keyfield)]
-            vals_to_join = [row[join_cur_fields.index(fname)] for fname in fields_to_join]
-            join_dict[jkey] = vals_to_join
-
-            if i == 0: dt_jkey = type(jkey).__name__
+    join_data = read_columns(fc_join, jkey_fields + fields_to_join)
+    jkey_idx, join_vals, dupe_keys = prep_join_table(join_data, jkey_fields, fields_to_join, agg_func=agg_func)
+
+    if len(dupe_keys) > 0:
+        dupe_handling = 'aggregated' if agg_func else 'using last row for each key'
+        print(f"\t{len(dupe_keys)} key values are in {fc_join} more than once ({dupe_handling}). " \
+            f"Examples: {dupe_keys[:5].tolist()}")
+
+    print("matching join keys to target table keys...")
+    f_oid = 'OID@'
+    target_keys = read_columns(fc_target, [f_oid] + tkey_fields)
+    jkinds = [key_kind(join_data[f]) for f in jkey_fields]
+    tkey_idx, _ = build_key_index([target_keys[f] for f in tkey_fields], jkinds)
+    jpositions = jkey_idx.get_indexer(tkey_idx)
+
+    is_match = jpositions >= 0
+    n_matched = int(is_match.sum())
+    n_unmatched = int((~is_match).sum())
+    n_unused = len(jkey_idx) - len(np.unique(jpositions[is_match]))
+
+    # {target OID: (values to join)} for matched rows only, built in one pass over whole arrays
+    matched_vals = [join_vals[fname][jpositions[is_match]] for fname in fields_to_join]
+    updates = dict(zip(target_keys[f_oid][is_match], zip(*matched_vals)))
 
     print("writing join data to target table...")
-    update_cur_fields = [fc_target_keyfield] + fields_to_join
-
-    def update_dtype(x, to_dtype):
-        # if the data types of the join key differ between the tables, set them to match
-        fdict = {'float': float(x), 'int': int(x), 'str': str(x)}
-        return fdict[to_dtype]
-
-    
-    with UpdateCursor(fc_target, update_cur_fields) as ucur:
+    with UpdateCursor(fc_target, [f_oid] + fields_to_join) as ucur:
         for row in ucur:
-            jkey = row[update_cur_fields.index(fc_target_keyfield)]
-            jkey = update_dtype(jkey, dt_jkey)
-
             # if a join id value is in the target table but not the join table,
             # skip the join. The values in the resulting joined column will be null for these cases.
-            if join_dict.get(jkey):
-                vals_to_join = join_dict[jkey]
-            else:
-                continue
+            vals_to_join = updates.get(row[0])
+            if vals_to_join is None: continue
 
-            row_out = [jkey] + vals_to_join
-            
-            row = row_out
-            ucur.updateRow(row)
+            ucur.updateRow([row[0], *vals_to_join])
 
     elapsed_sec = round(perf_counter() - start_time, 1)
 
     print(f"Successfully joined fields {fields_to_join} from {fc_join} onto {fc_target}" \
         f" in {elapsed_sec} seconds!")
+    print(f"\t{n_matched} target rows matched, {n_unmatched} target rows with no match, " \
+        f"{n_unused} join table keys not used.")
+
+    return {'matched': n_matched, 'target_unmatched': n_unmatched, 'join_unused': n_unused,
+            'join_dupe_keys': len(dupe_keys)}
 
 
 
@@ -105,6 +235,7 @@ if __name__ == '__main__':
     fc_jn = r'I:\Projects\Darren\2025BlueprintTables\Blueprint_Table_GIS\Blueprint_Table_GIS.gdb\pcl_trn_dists_csv'  # feature class whose data you want to join to the target fc
     jnfield_jnfc = 'parcelid' # join key for feature class you're pulling the new field from
     fc_jn_fields = ['dist_lbus', 'dist_lrt']  # list of fields in the "join" feature class that you want to append to the "target" feature class
+    jn_agg = None # None for one-to-one join, or 'sum', 'mean', 'first', 'count' (or {field: func} dict) to aggregate duplicate keys
 
     #===============RUN SCRIPT==============================
     env.overwriteOutput = True
@@ -114,7 +245,7 @@ if __name__ == '__main__':
     else:
         raise Exception("Process canceled.")
 
-    fast_join(target_fc, jnfield_target, fc_jn, jnfield_jnfc, fc_jn_fields)
+    fast_join(target_fc, jnfield_target, fc_jn, jnfield_jnfc, fc_jn_fields, agg_func=jn_agg)
     
 
 
@@ -15,53 +15,21 @@ Python Version: 3.x
 
 
 
-import re
+import sys
+from pathlib import Path
 from time import perf_counter
 
-import pyodbc
 import geopandas as gpd
 
+# helper modules shared by several script folders (sql_session, polygon_cache, etc.)
+sys.path.append(str(Path(__file__).resolve().parents[2].joinpath('shared')))
 from sqlqry2pandas import sqlqry_to_df
+from sql_session import get_session
 from esri_file_to_dataframe import esri_to_df
+from polygon_cache import cached_polygons
 
 
-def get_odbc_driver():
-    # gets name of ODBC driver, with name "ODBC Driver <version> for SQL Server"
-    drivers = [d for d in pyodbc.drivers() if 'ODBC Driver ' in d]
-    
-    if len(drivers) == 0:
-        errmsg = f"ERROR. No usable ODBC Driver found for SQL Server." \
-        f"drivers found include {drivers}. Check ODBC Administrator program" \
-        "for more information."
-        
-        raise Exception (errmsg)
-    else:
-        d_versions = [re.findall('\d+', dv)[0] for dv in drivers]
-        latest_version = max([int(v) for v in d_versions])
-        driver = f"ODBC Driver {latest_version} for SQL Server"
-    
-        return driver
-
-
-
-def run_sql(sql_driver, servername, db, sql_str, auto_commit=True): 
-    trustedconn = 'yes'
-
-    conn_str = f"DRIVER={sql_driver};" \
-        f"SERVER={servername};" \
-        f"DATABASE={db};" \
-        f"Trusted_Connection={trustedconn};" \
-        "autocommit=True;"
-        
-    conn = pyodbc.connect(conn_str)
-    conn.autocommit = auto_commit
-
-    cur = conn.cursor()
-    cur.execute(sql_str)
-    cur.commit()
-    cur.close()
-
-def apply_updates(tup_id_list, sql_tablename, tbl_uid_field, target_field, target_val, tup_sql_conn_info):
+def apply_updates(tup_id_list, sql_tablename, tbl_uid_field, target_field, target_val, session):
     qry_update = None # if no parcels in chunk are in poly, then no need to update tag; just keep as default
     if len(tup_id_list) == 1: # if only 1 parcel in chunk is in poly, then need to reformat tuple so you do not get sql syntax error
         qry_update = f"UPDATE {sql_tablename} SET {target_field} = {target_val} WHERE {tbl_uid_field} = {tup_id_list[0]}"
@@ -69,8 +37,7 @@ def apply_updates(tup_id_list, sql_tablename, tbl_uid_field, target_field, targe
         qry_update = f"UPDATE {sql_tablename} SET {target_field} = {target_val} WHERE {tbl_uid_field} IN {tup_id_list}"
 
     if qry_update:
-        # run_sql(driver, svrname, db_name, qry_update)--first 3 provided by tup_sql_conn_info
-        run_sql(*tup_sql_conn_info, qry_update)
+        session.execute(qry_update, label=f"update {target_field}")
 
 
 if __name__ == '__main__':
@@ -85,7 +52,7 @@ if __name__ == '__main__':
     # NOTE - this tagval is overridden if field_map is specified below
 
     reset_to_defaults = True
-	default_val = 0 
+    default_val = 0 
 
 
     # polygons you want to associate with points in table (e.g. want to find points in these polygons and tag points accordingly)
@@ -99,18 +66,22 @@ if __name__ == '__main__':
     # seldom-changed variables
     svrname = 'SQL-SVR'
     srid = 2226
-    driver = get_odbc_driver() 
+    tblname = target_tbl_name
+    session = get_session(db_name, servername=svrname) # pooled connections, reused for every update
 
     # reset all field values to a default value
-	if reset_to_defaults:
-		print("resetting field to default values...")
-		qry_setdefault = f"UPDATE {tblname} SET {f_to_update} = {default_val}"
-		run_sql(driver, svrname, db_name, qry_setdefault)
+    if reset_to_defaults:
+        print("resetting field to default values...")
+        qry_setdefault = f"UPDATE {tblname} SET {f_to_update} = {default_val}"
+        session.execute(qry_setdefault)
 
     print("loading polygon to associate with...")
     pclfields = [poly_id_field]
     if field_map: pclfields = [fn for fn in field_map.keys()]
-    search_polys = esri_to_df(source_polys, include_geom=True, field_list=pclfields, crs_val=srid)
+    # cached on disk after first load, so later runs against the same polygons skip the ESRI read (see polygon_cache.py)
+    search_polys = cached_polygons(source_polys, pclfields, srid,
+                                   lambda: esri_to_df(source_polys, include_geom=True, field_list=pclfields, crs_val=srid),
+                                   crs_mode='label')
 
     # set up query for pulling and tagging points in polygon
     pull_qry = f'SELECT {f_uid}, {f_x}, {f_y} FROM {tblname}'
@@ -119,7 +90,6 @@ if __name__ == '__main__':
 
     print("processing data...")
     rows_complete = 0
-    sql_conn_args = (driver, svrname, db_name)
     for chunk in data_chunks:
         chunk = gpd.GeoDataFrame(chunk, geometry=gpd.points_from_xy(chunk[f_x], chunk[f_y]), crs=f"EPSG:{srid}")
         tagged_pts = gpd.sjoin(chunk, search_polys, predicate='within')
@@ -133,15 +103,16 @@ if __name__ == '__main__':
                     chunk_tv = tagged_pts[tagged_pts[srcfield] == tval]
                     tagged_ids = tuple(chunk_tv[f_uid].values)
                     apply_updates(tup_id_list=tagged_ids, sql_tablename=tblname, tbl_uid_field=f_uid, 
-                                  target_field=destfield, target_val=tval, tup_sql_conn_info=sql_conn_args)
+                                  target_field=destfield, target_val=tval, session=session)
         else:
             # simple tagging, i.e., if in polygon, then give single "yes" value (e.g. 1)
             tagged_ids = tuple(tagged_pts[f_uid].values)
             apply_updates(tup_id_list=tagged_ids, sql_tablename=tblname, tbl_uid_field=f_uid, 
-                                  target_field=f_to_update, target_val=tagval, tup_sql_conn_info=sql_conn_args)
+                                  target_field=f_to_update, target_val=tagval, session=session)
         
         rows_complete += chunk.shape[0]
         if rows_complete % 50_000 == 0:
             print(f" {rows_complete} total rows processed...")
 
     print(f"complete. {rows_complete} rows processed.")
+    print(session.timing_report())
@@ -0,0 +1,146 @@
+"""
+Name: bulk_tag_writer.py
+Purpose: Writes (uid, value) updates to a SQL table in bulk. Rather than running one
+    UPDATE ... WHERE id IN (...) statement per chunk and per tag value, all (uid, value) pairs are streamed
+    into a temp staging table over one connection, then each target field is updated with a single
+    set-based UPDATE ... FROM join to the staging table.
+
+    Works with SQL Server through pyodbc (uses fast_executemany for the staging inserts), and with SQLite
+    (sqlite3 connection, dialect='sqlite') as a local stand-in for testing. Running this script directly
+    runs an example against an in-memory SQLite database.
+
+
+Author: Darren Conly
+Last Updated: Oct 2026
+Updated by:
+Copyright:   (c) SACOG
+Python Version: 3.x
+"""
+from time import perf_counter
+
+import numpy as np
+
+
+class TagWriter:
+    """
+    Stages (uid, value) pairs for one or more fields of sql_tablename, then applies them all with apply().
+    conn = open DB-API connection (pyodbc for SQL Server, sqlite3 for SQLite)
+    sql_tablename = table to update
+    tbl_uid_field = unique ID field of sql_tablename
+    dialect = 'mssql' or 'sqlite'
+    batch_size = number of rows sent per executemany() call
+
+    Typical workflow: writer = TagWriter(...) > writer.add(...) for each chunk of data > writer.apply()
+    """
+    def __init__(self, conn, sql_tablename, tbl_uid_field, dialect='mssql', batch_size=50_000):
+        if dialect not in ('mssql', 'sqlite'):
+            raise Exception(f"ERROR: dialect must be 'mssql' or 'sqlite'. '{dialect}' was given.")
+
+        self.conn = conn
+        self.sql_tablename = sql_tablename
+        self.tbl_uid_field = tbl_uid_field
+        self.dialect = dialect
+        self.batch_size = batch_size
+
+        self.stage_tables = {} # {target field: staging table name}
+        self.rows_staged = {} # {target field: number of rows staged}
+
+    def _cursor(self):
+        cur = self.conn.cursor()
+        if hasattr(cur, 'fast_executemany'): cur.fast_executemany = True # pyodbc only
+        return cur
+
+    def _create_stage(self, target_field):
+        # staging table gets same data types as the target table's uid and target fields
+        if self.dialect == 'mssql':
+            stage = f"#stage_{target_field}"
+            # the UNION keeps SELECT INTO from copying any IDENTITY property of the uid field
+            sql_create = f"SELECT TOP 0 {self.tbl_uid_field} AS uid, {target_field} AS val INTO {stage} " \
+                f"FROM {self.sql_tablename} UNION ALL " \
+                f"SELECT TOP 0 {self.tbl_uid_field}, {target_field} FROM {self.sql_tablename}"
+        else:
+            stage = f"stage_{target_field}"
+            sql_create = f"CREATE TEMP TABLE {stage} AS SELECT {self.tbl_uid_field} AS uid, {target_field} AS val " \
+                f"FROM {self.sql_tablename} LIMIT 0"
+
+        cur = self._cursor()
+        cur.execute(sql_create)
+        cur.close()
+
+        self.stage_tables[target_field] = stage
+        self.rows_staged[target_field] = 0
+
+    def add(self, target_field, uids, values):
+        """
+        Stages updates for target_field.
+        uids = array of uid values
+        values = array of values to set, one per uid, or a single value to set for all uids
+        """
+        if len(uids) == 0: return
+        if target_field not in self.stage_tables:
+            self._create_stage(target_field)
+
+        uids = np.asarray(uids).tolist() # numpy types to python types for the DB driver
+        if np.ndim(values) == 0:
+            values = [np.asarray(values).item()] * len(uids)
+        else:
+            values = np.asarray(values, dtype=object).tolist()
+
+        rows = list(zip(uids, values))
+        sql_insert = f"INSERT INTO {self.stage_tables[target_field]} (uid, val) VALUES (?, ?)"
+
+        cur = self._cursor()
+        for i in range(0, len(rows), self.batch_size):
+            cur.executemany(sql_insert, rows[i:i + self.batch_size])
+        cur.close()
+
+        self.rows_staged[target_field] += len(rows)
+
+    def apply(self):
+        """
+        Updates each staged target field with one set-based UPDATE, then drops the staging tables.
+        Returns dict of {target field: number of rows updated}
+        """
+        start_time = perf_counter()
+        rows_updated = {}
+        cur = self._cursor()
+        for target_field, stage in self.stage_tables.items():
+            cur.execute(f"CREATE INDEX idx_{target_field}_uid ON {stage} (uid)")
+
+            if self.dialect == 'mssql':
+                sql_update = f"UPDATE t SET t.{target_field} = s.val FROM {self.sql_tablename} t " \
+                    f"INNER JOIN {stage} s ON t.{self.tbl_uid_field} = s.uid"
+            else:
+                sql_update = f"UPDATE {self.sql_tablename} SET {target_field} = s.val FROM {stage} AS s " \
+                    f"WHERE {self.sql_tablename}.{self.tbl_uid_field} = s.uid"
+
+            cur.execute(sql_update)
+            rows_updated[target_field] = cur.rowcount
+            cur.execute(f"DROP TABLE {stage}")
+
+        self.conn.commit()
+        cur.close()
+
+        self.stage_tables = {}
+        self.rows_staged = {}
+
+        et_sec = round(perf_counter() - start_time, 1)
+        print(f"Updated {rows_updated} rows in {self.sql_tablename} in {et_sec} seconds.")
+
+        return rows_updated
+
+
+if __name__ == '__main__':
+    # example using SQLite as a local stand-in for SQL Server
+    import sqlite3
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE parcels (PARCELID INTEGER PRIMARY KEY, JOBCTR TEXT, EJ INTEGER)")
+    conn.executemany("INSERT INTO parcels VALUES (?, NULL, 0)", [(i,) for i in range(100_000)])
+
+    writer = TagWriter(conn, 'parcels', 'PARCELID', dialect='sqlite')
+    writer.add('JOBCTR', np.arange(0, 1000), np.array(['Downtown', 'Midtown'] * 500))
+    writer.add('EJ', np.arange(500, 50_000), 1)
+    writer.apply()
+
+    print(conn.execute("SELECT JOBCTR, EJ, COUNT(*) FROM parcels GROUP BY JOBCTR, EJ").fetchall())
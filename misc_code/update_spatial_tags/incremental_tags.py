@@ -0,0 +1,147 @@
+"""
+Name: incremental_tags.py
+Purpose: Supports incremental spatial tagging, where only rows that are new or have moved since the last run
+    are re-tagged, instead of resetting and re-tagging every row of the table.
+
+    After each run, a snapshot of the table is saved as a parquet file with a hash of each row's x/y values and
+    tag field values as written by the run (and optionally of a server-side change column, e.g. a rowversion or
+    CHECKSUM()). On the next run, each row's hash is compared to the snapshot to find rows that are:
+        - new (uid not in snapshot)
+        - changed (moved, or tag field changed since the last run, e.g. by another tool or a manual edit)
+        - unchanged (skipped)
+    Rows in the snapshot that are no longer in the table are deleted rows. This is intentional: a deleted row has
+    no tag left to update, so deleted rows are only counted in the run report and dropped from the new snapshot.
+
+    The snapshot also stores a key for the tagging settings (polygon file version, fields, tag values, etc.).
+    If any of those have changed, the snapshot is not used and all rows are re-tagged.
+
+
+Author: Darren Conly
+Last Updated: Oct 2026
+Updated by:
+Copyright:   (c) SACOG
+Python Version: 3.x
+"""
+import json
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_SNAPSHOT_DIR = Path.home().joinpath('.spatial_tag_snapshots')
+SNAPSHOT_VERSION = 2 # snapshots saved with a different version (e.g. before tag values were hashed) are not used
+
+
+def _hash_values(col):
+    # values as read from the table and as written by the tagger (e.g. 1 vs 1.0, None vs NaN) hash the same
+    num_col = pd.to_numeric(col, errors='coerce')
+    if (num_col.notna() == col.notna()).all():
+        return num_col.astype('float64')
+
+    return col.astype(object).where(col.notna(), None).map(str)
+
+
+def row_hashes(df, hash_fields):
+    # returns uint64 hash of the values in hash_fields for each row of df
+    hash_df = pd.DataFrame({f: _hash_values(df[f]) for f in hash_fields})
+    return pd.util.hash_pandas_object(hash_df, index=False).to_numpy()
+
+
+class TagSnapshot:
+    """
+    Snapshot of (uid, row hash) for the rows of a table as of the last tagging run.
+    dbname, tablename = table being tagged
+    target_fields = fields being tagged
+    settings = dict of everything that affects the tag values (polygon file key, field map, tag values, etc.).
+        Snapshot is only used if settings are the same as when it was saved.
+
+    Typical workflow: snap = TagSnapshot(...) > snap.load() > for each chunk of rows, snap.rows_to_tag(...), then
+        snap.record_written(...) for the rows whose tags were written > snap.deleted_uids() > snap.save() after tags
+        are written
+    """
+    def __init__(self, dbname, tablename, target_fields, settings, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+        self.path = Path(snapshot_dir).joinpath(f"{dbname}_{tablename}_{'_'.join(target_fields)}.parquet")
+        settings = {**settings, 'snapshot_version': SNAPSHOT_VERSION}
+        self.settings_key = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+        self.prev_uids = None # uids from last run, or None if no usable snapshot
+        self.prev_hashes = None # hash of each of prev_uids
+        self.cur_uids, self.cur_hashes = [], [] # uids and hashes seen this run
+        self.written_uids, self.written_hashes = [], [] # uids and hashes of rows, with tag values as written this run
+        self.counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0}
+
+    def load(self):
+        # loads snapshot from last run. Returns True if there is a usable snapshot.
+        if not self.path.exists():
+            return False
+
+        tbl = pq.read_table(self.path)
+        if tbl.schema.metadata.get(b'settings_key', b'').decode() != self.settings_key:
+            print("\ttagging settings or polygons have changed since last snapshot. All rows will be tagged.")
+            return False
+
+        self.prev_uids = pd.Index(tbl.column('uid').to_numpy())
+        self.prev_hashes = tbl.column('row_hash').to_numpy()
+        return True
+
+    def rows_to_tag(self, uids, hashes):
+        """
+        Records uids and hashes of a chunk of current rows. Returns True/False array of which rows are new or changed
+        since the snapshot (all True if there is no snapshot).
+        """
+        uids, hashes = np.asarray(uids), np.asarray(hashes)
+        self.cur_uids.append(uids)
+        self.cur_hashes.append(hashes)
+
+        if self.prev_uids is None:
+            self.counts['new'] += len(uids)
+            return np.ones(len(uids), dtype=bool)
+
+        pos = self.prev_uids.get_indexer(uids)
+        is_new = pos == -1
+        is_changed = ~is_new & (self.prev_hashes[pos] != hashes)
+
+        self.counts['new'] += int(is_new.sum())
+        self.counts['changed'] += int(is_changed.sum())
+        self.counts['unchanged'] += int(len(uids) - is_new.sum() - is_changed.sum())
+
+        return is_new | is_changed
+
+    def record_written(self, uids, hashes):
+        """
+        Records hashes of rows whose tags were written this run, with the tag values as written rather than as read.
+        These replace the hashes recorded by rows_to_tag() in the saved snapshot.
+        """
+        self.written_uids.append(np.asarray(uids))
+        self.written_hashes.append(np.asarray(hashes))
+
+    def deleted_uids(self):
+        # uids in the snapshot that were not in any chunk of current rows. Only counted; nothing is updated for them.
+        if self.prev_uids is None:
+            return np.array([])
+
+        cur_uids = np.concatenate(self.cur_uids) if self.cur_uids else np.array([])
+        deleted = self.prev_uids[~self.prev_uids.isin(cur_uids)].to_numpy()
+        self.counts['deleted'] = len(deleted)
+
+        return deleted
+
+    def save(self):
+        # saves uids and hashes of current rows as the new snapshot. Deleted rows are not in it.
+        uids = np.concatenate(self.cur_uids) if self.cur_uids else np.array([])
+        hashes = np.concatenate(self.cur_hashes) if self.cur_hashes else np.array([], dtype='uint64')
+        if self.written_uids:
+            pos = pd.Index(uids).get_indexer(np.concatenate(self.written_uids))
+            hashes[pos[pos >= 0]] = np.concatenate(self.written_hashes)[pos >= 0]
+        tbl = pa.table({'uid': uids, 'row_hash': hashes}).replace_schema_metadata({'settings_key': self.settings_key})
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        pq.write_table(tbl, tmp_path)
+        tmp_path.replace(self.path)
+
+    def report(self):
+        return ', '.join(f"{v} {k}" for k, v in self.counts.items())
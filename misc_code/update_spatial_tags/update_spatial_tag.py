@@ -5,6 +5,11 @@ Purpose: for SQL Server table with x/y values, tag which records are within user
 	Example 2: can also effectively do spatial join, e.g., getting the community type each point is in based on intersection
 		with a layer of polygons representing community types.
 
+    In incremental mode, only rows that are new or have moved since the last run are re-tagged (see incremental_tags.py).
+
+    All tag updates go through one connection: (uid, value) pairs are bulk-loaded into a temp staging table,
+    then each target field gets a single set-based UPDATE (see bulk_tag_writer.py).
+
 
 Author: Darren Conly
 Last Updated: Mar 2025
@@ -15,62 +20,70 @@ Python Version: 3.x
 
 
 
-import re
+import sys
+from pathlib import Path
 from time import perf_counter
 
-import pyodbc
+import numpy as np
+import pandas as pd
 import geopandas as gpd
 
+# helper modules shared by several script folders (sql_session, polygon_cache, etc.)
+sys.path.append(str(Path(__file__).resolve().parents[2].joinpath('shared')))
 from sqlqry2pandas import sqlqry_to_df
+from sql_session import get_session
 from esri_file_to_dataframe import esri_to_df
-
-
-def get_odbc_driver():
-    # gets name of ODBC driver, with name "ODBC Driver <version> for SQL Server"
-    drivers = [d for d in pyodbc.drivers() if 'ODBC Driver ' in d]
-    
-    if len(drivers) == 0:
-        errmsg = f"ERROR. No usable ODBC Driver found for SQL Server." \
-        f"drivers found include {drivers}. Check ODBC Administrator program" \
-        "for more information."
-        
-        raise Exception (errmsg)
+from polygon_cache import cached_polygons, cache_key
+from polygon_tiling import tile_polygon_gdf
+from bulk_tag_writer import TagWriter
+from incremental_tags import TagSnapshot, row_hashes
+
+TIE_BREAKS = ('first', 'largest_overlap', 'min_id')
+
+
+def add_tie_rank(polys, tie_break='first', id_field=None):
+    """
+    Adds field 'tie_rank' to polys, used to pick which polygon a point gets its tag from if it is in more than
+    one polygon. The polygon with the lowest tie_rank wins.
+    tie_break = 'first' (first polygon in the polygon file), 'min_id' (polygon with lowest id_field value), or
+        'largest_overlap' (polygon the point's feature overlaps most. For points, which overlap every polygon they are
+        in by the same amount, this is the largest polygon.)
+    """
+    if tie_break not in TIE_BREAKS:
+        raise Exception(f"ERROR: tie_break must be one of {TIE_BREAKS}. '{tie_break}' was given.")
+
+    if tie_break == 'first':
+        rank = np.arange(polys.shape[0])
+    elif tie_break == 'min_id':
+        rank = polys[id_field].rank(method='first').to_numpy()
     else:
-        d_versions = [re.findall('\d+', dv)[0] for dv in drivers]
-        latest_version = max([int(v) for v in d_versions])
-        driver = f"ODBC Driver {latest_version} for SQL Server"
-    
-        return driver
-
+        rank = (-polys.geometry.area).rank(method='first').to_numpy()
 
+    return polys.assign(tie_rank=rank)
 
-def run_sql(sql_driver, servername, db, sql_str, auto_commit=True): 
-    trustedconn = 'yes'
 
-    conn_str = f"DRIVER={sql_driver};" \
-        f"SERVER={servername};" \
-        f"DATABASE={db};" \
-        f"Trusted_Connection={trustedconn};" \
-        "autocommit=True;"
-        
-    conn = pyodbc.connect(conn_str)
-    conn.autocommit = auto_commit
+def resolve_tag_values(tagged_pts, uids, f_uid, field_map=None, f_to_update=None, tagval=1, default_val=None):
+    """
+    Returns {destination field: array with tag value for each of uids}, from spatial join result tagged_pts.
+    If a uid is in tagged_pts more than once (point in overlapping polygons), the row with the lowest tie_rank is used.
+    uids not in tagged_pts get default_val.
+    field_map = {polygon field: destination field} to tag with polygon field values. If None, tagged points get
+        tagval in f_to_update.
+    """
+    tagged_pts = tagged_pts.sort_values('tie_rank', kind='stable').drop_duplicates(subset=f_uid)
+    pos = pd.Index(tagged_pts[f_uid]).get_indexer(uids)
+    is_tagged = pos >= 0
 
-    cur = conn.cursor()
-    cur.execute(sql_str)
-    cur.commit()
-    cur.close()
+    if not field_map:
+        return {f_to_update: np.where(is_tagged, tagval, default_val)}
 
-def apply_updates(tup_id_list, sql_tablename, tbl_uid_field, target_field, target_val, tup_sql_conn_info):
-    qry_update = None # if no parcels in chunk are in poly, then no need to update tag; just keep as default
-    if len(tup_id_list) == 1: # if only 1 parcel in chunk is in poly, then need to reformat tuple so you do not get sql syntax error
-        qry_update = f"UPDATE {sql_tablename} SET {target_field} = {target_val} WHERE {tbl_uid_field} = {tup_id_list[0]}"
-    elif len(tup_id_list) > 1:
-        qry_update = f"UPDATE {sql_tablename} SET {target_field} = {target_val} WHERE {tbl_uid_field} IN {tup_id_list}"
+    tag_vals = {}
+    for srcfield, destfield in field_map.items():
+        vals = np.full(len(uids), default_val, dtype=object)
+        vals[is_tagged] = tagged_pts[srcfield].to_numpy(dtype=object)[pos[is_tagged]]
+        tag_vals[destfield] = vals
 
-    if qry_update:
-        # run_sql(driver, svrname, db_name, qry_update)--first 3 provided by tup_sql_conn_info
-        run_sql(*tup_sql_conn_info, qry_update)
+    return tag_vals
 
 
 if __name__ == '__main__':
@@ -95,53 +108,145 @@ if __name__ == '__main__':
     # field map effectively does a spatial join, rather than simple 1/0 tagging
     field_map = {'Status': 'JOBCTR'} # {source field in polygon file: destination field in parcel table}
 
+    # which polygon to take the tag from if a point is in overlapping polygons: 'first', 'largest_overlap', or 'min_id'
+    # (lowest poly_id_field value)
+    tie_break = 'first'
+
+    # split polygons into tiles of no more than this many vertices, which makes point-in-polygon tests much faster
+    # for large, detailed polygons (e.g. county or dissolved EJ area). Set to None to use polygons as-is.
+    tile_max_vertices = 200
+
+    # only re-tag rows that are new or have moved since the last run. If there is no snapshot from a previous run
+    # with the same settings and polygons, all rows are tagged (and the field is reset if reset_to_defaults is True).
+    incremental = True
+    # optional SQL expression to also check for changes, e.g. 'CHECKSUM(LUTYPE)'. If it can change when this script
+    # writes a row (e.g. a rowversion or last-edited column), written rows are re-read after the commit so that they
+    # do not look changed on the next run.
+    change_expr = None
+
     #==============RUN SCRIPT=======================
     # seldom-changed variables
     svrname = 'SQL-SVR'
     srid = 2226
-    driver = get_odbc_driver() 
+    session = get_session(db_name, servername=svrname)
 
-    # reset all field values to a default value
-    if reset_to_defaults:
-        print("resetting field to default values...")
-        qry_setdefault = f"UPDATE {target_tbl_name} SET {f_to_update} = {default_val}"
-        run_sql(driver, svrname, db_name, qry_setdefault)
+    # one pooled connection for all updates. Not autocommit, so reset and tag updates are committed together at the end.
+    conn = session.engine.raw_connection()
+    tag_writer = TagWriter(conn, target_tbl_name, f_uid, dialect='mssql')
 
     print("loading polygon to associate with...")
     pclfields = [poly_id_field]
-    if field_map: pclfields = [fn for fn in field_map.keys()]
-    search_polys = esri_to_df(source_polys, include_geom=True, field_list=pclfields, crs_val=srid)
+    if field_map: pclfields += [fn for fn in field_map.keys() if fn != poly_id_field]
+    # cached on disk after first load, so later runs against the same polygons skip the ESRI read (see polygon_cache.py)
+    search_polys = cached_polygons(source_polys, pclfields, srid,
+                                   lambda: esri_to_df(source_polys, include_geom=True, field_list=pclfields, crs_val=srid),
+                                   crs_mode='label')
+    search_polys = add_tie_rank(search_polys, tie_break, poly_id_field) # tiles below keep their polygon's rank
+
+    sjoin_predicate = 'within'
+    if tile_max_vertices:
+        # points covered by a polygon tile are covered by the polygon, so 'covered_by' is used for the tiles.
+        # Only differs from 'within' for points exactly on the polygon's outer boundary.
+        search_polys = tile_polygon_gdf(search_polys, max_vertices=tile_max_vertices)
+        sjoin_predicate = 'covered_by'
+        print(f"\tsplit polygons into {search_polys.shape[0]} tiles")
+
+    target_fields = list(field_map.values()) if field_map else [f_to_update]
+    snapshot = None
+    run_incremental = False
+    if incremental:
+        tag_settings = {'polygons': cache_key(source_polys, pclfields, srid, 'label'), 'field_map': field_map,
+                        'f_to_update': f_to_update, 'tagval': tagval, 'default_val': default_val,
+                        'tile_max_vertices': tile_max_vertices, 'change_expr': change_expr, 'tie_break': tie_break}
+        snapshot = TagSnapshot(db_name, target_tbl_name, target_fields, tag_settings)
+        run_incremental = snapshot.load()
+        if run_incremental: print("incremental run: only new or changed rows will be tagged...")
 
     # set up query for pulling and tagging points in polygon
-    pull_qry = f'SELECT {f_uid}, {f_x}, {f_y} FROM {target_tbl_name}'
+    # current tag values are pulled and hashed too, so that tags changed since the last run (e.g. by another tool or
+    # a manual edit) are re-tagged in incremental runs
+    hash_fields = [f_x, f_y] + target_fields
+    str_change_col = ''
+    if change_expr:
+        str_change_col = f", {change_expr} AS row_change" # computed on the server
+        hash_fields.append('row_change')
+    pull_qry = f'SELECT {f_uid}, {f_x}, {f_y}, {", ".join(target_fields)}{str_change_col} FROM {target_tbl_name}'
     data_chunks = sqlqry_to_df(query_str=pull_qry, dbname=db_name, 
-    servername=svrname, trustedconn='yes', chunk_size=10_000)
+    servername=svrname, trustedconn='yes', chunk_size=10_000, use_arrow=True, xy_fields=(f_x, f_y), crs=f"EPSG:{srid}",
+    partition_field=f_uid, workers=4) # chunks are uid ranges, read 4 at a time on pooled connections
 
     print("processing data...")
     rows_complete = 0
-    sql_conn_args = (driver, svrname, db_name)
+    reread_uids = [] # uids of written rows to re-read for the snapshot after the commit, if change_expr is set
+    report_every = 50_000
+    next_report = report_every # chunk sizes vary, so progress is printed each time a multiple of this is passed
     for chunk in data_chunks:
-        chunk = gpd.GeoDataFrame(chunk, geometry=gpd.points_from_xy(chunk[f_x], chunk[f_y]), crs=f"EPSG:{srid}")
-        tagged_pts = gpd.sjoin(chunk, search_polys, predicate='within')
-        tagged_pts_len = tagged_pts.shape[0]
-        
-        if field_map:
-            # spatial join tagging (pull attribute values from polygons to populate point fields)
-            for srcfield, destfield in field_map.items():
-                unique_tvals = tagged_pts[srcfield].drop_duplicates()
-                for tval in unique_tvals:
-                    chunk_tv = tagged_pts[tagged_pts[srcfield] == tval]
-                    tagged_ids = tuple(chunk_tv[f_uid].values)
-                    apply_updates(tup_id_list=tagged_ids, sql_tablename=target_tbl_name, tbl_uid_field=f_uid, 
-                                  target_field=destfield, target_val=tval, tup_sql_conn_info=sql_conn_args)
-        else:
-            # simple tagging, i.e., if in polygon, then give single "yes" value (e.g. 1)
-            tagged_ids = tuple(tagged_pts[f_uid].values)
-            apply_updates(tup_id_list=tagged_ids, sql_tablename=target_tbl_name, tbl_uid_field=f_uid, 
-                                  target_field=f_to_update, target_val=tagval, tup_sql_conn_info=sql_conn_args)
-        
         rows_complete += chunk.shape[0]
-        if rows_complete % 50_000 == 0:
+        if rows_complete >= next_report:
             print(f" {rows_complete} total rows processed...")
+            next_report = (rows_complete // report_every + 1) * report_every
+
+        if snapshot:
+            to_tag = snapshot.rows_to_tag(chunk[f_uid].to_numpy(), row_hashes(chunk, hash_fields))
+            if run_incremental:
+                chunk = chunk[to_tag]
+                if chunk.shape[0] == 0: continue
+
+        # current tag values are left out of the join, so they cannot clash with polygon field names
+        tagged_pts = gpd.sjoin(chunk.drop(columns=target_fields), search_polys, predicate=sjoin_predicate)
+
+        # one value per uid for each destination field, all written with one call per field. Field was not reset in
+        # incremental runs, so every re-tagged row gets a value, including the default for rows that are in no polygon.
+        # Otherwise only the tagged rows are written. A point on the edge between 2 tiles of the same polygon, or in
+        # overlapping polygons, gets one value based on tie_break.
+        uids = chunk[f_uid].to_numpy() if run_incremental else tagged_pts[f_uid].unique()
+        tag_vals = resolve_tag_values(tagged_pts, uids, f_uid, field_map=field_map, f_to_update=f_to_update,
+                                      tagval=tagval, default_val=default_val)
+        for destfield, vals in tag_vals.items():
+            tag_writer.add(target_field=destfield, uids=uids, values=vals)
+
+        if snapshot:
+            # snapshot gets the tag values as written, not as read. In non-incremental runs, rows in no polygon were
+            # reset to default_val (if reset_to_defaults) or kept their current value.
+            written_uids = chunk[f_uid].to_numpy() if reset_to_defaults and not run_incremental else uids
+            if change_expr:
+                reread_uids.append(written_uids) # row_change is only known once the tags are committed
+            else:
+                written_vals = tag_vals if written_uids is uids else \
+                    resolve_tag_values(tagged_pts, written_uids, f_uid, field_map=field_map, f_to_update=f_to_update,
+                                       tagval=tagval, default_val=default_val)
+                written = chunk.set_index(f_uid).loc[written_uids, hash_fields].assign(**written_vals)
+                snapshot.record_written(written_uids, row_hashes(written, hash_fields))
+
+    # reset all field values to a default value. Done only after all points are read, in the same transaction as the
+    # tag updates, because the uncommitted table-wide update would block the partitioned reads on other connections.
+    if reset_to_defaults and not run_incremental:
+        print("resetting field to default values...")
+        qry_setdefault = f"UPDATE {target_tbl_name} SET {f_to_update} = {default_val}"
+        cur = conn.cursor()
+        cur.execute(qry_setdefault)
+        cur.close()
+
+    print("writing tags to table...")
+    tag_writer.apply()
+    conn.close() # returns connection to the pool
+
+    if snapshot and reread_uids:
+        # change_expr may be maintained by the server and change when the tags are written, so the written rows are
+        # hashed as they are now, after the commit
+        print("re-reading written rows for snapshot...")
+        reread_uids = np.concatenate(reread_uids)
+        for chunk in sqlqry_to_df(query_str=pull_qry, dbname=db_name, servername=svrname, trustedconn='yes',
+                                  chunk_size=10_000, use_arrow=True, partition_field=f_uid, workers=4):
+            chunk = chunk[chunk[f_uid].isin(reread_uids)]
+            snapshot.record_written(chunk[f_uid].to_numpy(), row_hashes(chunk, hash_fields))
+
+    if snapshot:
+        # deleted rows are intentionally not handled: they have no tag left to update, so they are only counted and
+        # left out of the new snapshot
+        n_deleted = len(snapshot.deleted_uids())
+        if n_deleted > 0: print(f"\t{n_deleted} rows deleted from {target_tbl_name} since last snapshot")
+        snapshot.save()
+        print(f"\trows since last snapshot: {snapshot.report()}")
 
     print(f"complete. {rows_complete} rows processed.")
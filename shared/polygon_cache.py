@@ -0,0 +1,111 @@
+"""
+Name: polygon_cache.py
+Purpose: On-disk cache of polygon layers that have been loaded from ESRI files and reprojected, so that
+    repeated tagging runs against the same polygons (e.g. EJ areas, job centers) skip the slow ESRI read.
+
+    Each cached layer is a GeoParquet file with a bounding box column for each polygon. Cache entries are keyed by:
+        - the polygon file's path, last-modified time and size (for file geodatabases, of the whole .gdb folder)
+        - the list of fields loaded
+        - the target CRS
+        - how the loader gets the polygons into the target CRS: reprojecting them, or only labeling them with it
+    so editing the polygons, or asking for different fields, a different CRS or a different loader, makes a new
+    cache entry.
+
+    When the cache's total size is more than max_cache_bytes, the least recently used entries are deleted.
+
+
+Author: Darren Conly
+Last Updated: Oct 2026
+Updated by:
+Copyright:   (c) SACOG
+Python Version: 3.x
+"""
+import os
+import re
+import json
+import hashlib
+from pathlib import Path
+from time import perf_counter
+
+import geopandas as gpd
+
+DEFAULT_CACHE_DIR = Path.home().joinpath('.polygon_cache')
+
+# files that ArcGIS makes and deletes while a layer is open or being read (e.g. schema and edit locks in a .gdb),
+# which do not mean the data changed
+TRANSIENT_SUFFIXES = ('.lock', '.tmp')
+
+
+def source_stats(fc_path):
+    # returns (total size in bytes, latest modified time) of files making up fc_path, not counting lock files
+    gdb_match = re.match(r'(.+?\.gdb)([\\/]|$)', str(fc_path), flags=re.IGNORECASE)
+    fc_path = Path(fc_path)
+
+    if gdb_match:
+        # feature classes in a file geodatabase do not have their own files, so use the whole .gdb folder
+        files = [f for f in Path(gdb_match.group(1)).rglob('*')
+                 if f.is_file() and not f.name.lower().endswith(TRANSIENT_SUFFIXES)]
+    elif fc_path.suffix.lower() == '.shp':
+        files = [f for f in fc_path.parent.glob(f"{fc_path.stem}.*") # .shp, .dbf, .prj, etc.
+                 if not f.name.lower().endswith(TRANSIENT_SUFFIXES)]
+    else:
+        files = [fc_path]
+
+    stats = [f.stat() for f in files]
+    return sum(st.st_size for st in stats), max(st.st_mtime for st in stats)
+
+
+def cache_key(fc_path, field_list, target_crs, crs_mode='reproject'):
+    size, mtime = source_stats(fc_path)
+    key_data = {'path': str(Path(fc_path).resolve()), 'size': size, 'mtime': mtime,
+                'fields': list(field_list), 'crs': str(target_crs), 'crs_mode': crs_mode}
+
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def evict_lru(cache_dir, max_cache_bytes, keep=None):
+    # deletes least recently used cache files, other than keep, until total size of cache is no more than max_cache_bytes
+    entries = [(f.stat().st_mtime, f.stat().st_size, f) for f in Path(cache_dir).glob('*.parquet')]
+    total_bytes = sum(e[1] for e in entries)
+
+    for _, size, f in sorted(entries):
+        if total_bytes <= max_cache_bytes: break
+        if f == keep: continue
+        f.unlink(missing_ok=True)
+        total_bytes -= size
+
+
+def cached_polygons(fc_path, field_list, target_crs, load_func, crs_mode='reproject', cache_dir=DEFAULT_CACHE_DIR,
+                    max_cache_bytes=2_000_000_000):
+    """
+    Returns geodataframe of polygons from fc_path in target_crs, from the cache if possible.
+    field_list = fields to load, in addition to geometry
+    target_crs = CRS polygons are reprojected to, e.g. 2226
+    load_func = function with no arguments that loads the polygons in target_crs. Only called if the
+        polygons are not in the cache. E.g. lambda: esri_to_df(fc_path, ...).to_crs(target_crs)
+    crs_mode = how load_func gets the polygons into target_crs. 'reproject' if it reprojects them (.to_crs), or
+        'label' if it only sets their CRS to target_crs (e.g. esri_to_df(..., crs_val=target_crs)). Part of the
+        cache key, since the two give different geometry for polygons that are not already in target_crs.
+    cache_dir = folder cache files are kept in
+    max_cache_bytes = max total size of the cache folder
+    """
+    start_time = perf_counter()
+    cache_dir = Path(cache_dir)
+    cache_file = cache_dir.joinpath(f"{cache_key(fc_path, field_list, target_crs, crs_mode)}.parquet")
+
+    if cache_file.exists():
+        gdf = gpd.read_parquet(cache_file)
+        os.utime(cache_file) # marks entry as recently used
+        print(f"\tloaded {gdf.shape[0]} polygons from cache in {round(perf_counter() - start_time, 1)} seconds")
+        return gdf
+
+    gdf = load_func()
+
+    # written to temp file first so that an interrupted write never leaves a partial cache entry
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    gdf.to_parquet(tmp_file, index=False, write_covering_bbox=True)
+    os.replace(tmp_file, cache_file)
+    evict_lru(cache_dir, max_cache_bytes, keep=cache_file)
+
+    return gdf
@@ -0,0 +1,161 @@
+"""
+Name: polygon_tiling.py
+Purpose: Speeds up point-in-polygon and other spatial selection against very large, highly-vertexed polygons
+    (e.g. a county boundary or a dissolved EJ area) by splitting each polygon into a grid of smaller pieces
+    with quadtree subdivision.
+
+    Each polygon's bounding box is split into 4 until every piece has no more than max_vertices vertices.
+    Grid tiles that are entirely inside the polygon are kept as simple 4-sided "interior" tiles, so any feature
+    inside an interior tile is accepted without testing it against the polygon's vertices at all.
+
+    Running this script directly runs a benchmark on a synthetic polygon.
+
+
+Author: Darren Conly
+Last Updated: Oct 2026
+Updated by:
+Copyright:   (c) SACOG
+Python Version: 3.x
+"""
+from time import perf_counter
+
+import numpy as np
+import shapely
+
+
+def tile_polygons(geoms, max_vertices=200, max_depth=12):
+    """
+    Splits polygons into pieces with quadtree subdivision.
+    geoms = array of shapely polygons
+    max_vertices = max number of vertices in each boundary piece
+    max_depth = max number of times a tile is split. Pieces at this depth are kept even if they have more than
+        max_vertices vertices.
+    Returns (pieces, source position of each piece in geoms, True/False whether each piece is an interior tile)
+    """
+    geoms = np.asarray(geoms, dtype=object)
+
+    # each tile is clipped from its parent piece rather than from the whole polygon, so the work per level
+    # is proportional to the total number of vertices, not to number of tiles x vertices.
+    src = np.arange(len(geoms))
+    parents = geoms
+    boxes = shapely.box(*shapely.bounds(geoms).T)
+
+    out_pieces, out_src, out_interior = [], [], []
+    for depth in range(max_depth + 1):
+        if len(src) == 0: break
+
+        # tiles entirely inside their polygon
+        shapely.prepare(parents)
+        interior = shapely.covers(parents, boxes)
+        out_pieces.append(boxes[interior])
+        out_src.append(src[interior])
+        out_interior.append(np.ones(interior.sum(), dtype=bool))
+        src, boxes, parents = src[~interior], boxes[~interior], parents[~interior]
+
+        # tiles along polygon boundary
+        # clip_by_rect is much faster than a general intersection, but only takes one rectangle at a time.
+        # Number of tiles is small compared to number of vertices, so looping over tiles is OK.
+        pieces = np.array([shapely.clip_by_rect(parent, *bnds) for parent, bnds
+                           in zip(parents, shapely.bounds(boxes))], dtype=object)
+        has_area = ~shapely.is_empty(pieces)
+        src, boxes, pieces = src[has_area], boxes[has_area], pieces[has_area]
+
+        is_small = shapely.get_num_coordinates(pieces) <= max_vertices
+        if depth == max_depth: is_small[:] = True
+        out_pieces.append(pieces[is_small])
+        out_src.append(src[is_small])
+        out_interior.append(np.zeros(is_small.sum(), dtype=bool))
+
+        # split the remaining tiles into 4 for next level
+        src, boxes, parents = src[~is_small], boxes[~is_small], pieces[~is_small]
+        xmin, ymin, xmax, ymax = shapely.bounds(boxes).T
+        xmid, ymid = (xmin + xmax) / 2, (ymin + ymax) / 2
+        boxes = np.concatenate([shapely.box(xmin, ymin, xmid, ymid), shapely.box(xmid, ymin, xmax, ymid),
+                                shapely.box(xmin, ymid, xmid, ymax), shapely.box(xmid, ymid, xmax, ymax)])
+        src = np.tile(src, 4)
+        parents = np.tile(parents, 4)
+
+    return np.concatenate(out_pieces), np.concatenate(out_src), np.concatenate(out_interior)
+
+
+def tile_polygon_gdf(poly_gdf, max_vertices=200):
+    """
+    Geodataframe version of tile_polygons(). Each piece keeps the attributes of the polygon it came from,
+    plus field 'src_poly_idx' with the index value of that polygon.
+    A point is covered by (within or on the boundary of) a polygon if and only if it is covered by one of its pieces,
+    so spatial joins to the pieces with predicate='covered_by' give the same result as joins to the original polygons.
+    """
+    import geopandas as gpd
+
+    pieces, src, interior = tile_polygons(poly_gdf.geometry.values.to_numpy(), max_vertices=max_vertices)
+    attrs = poly_gdf.drop(columns=poly_gdf.geometry.name).iloc[src]
+    attrs = attrs.assign(src_poly_idx=poly_gdf.index[src], is_interior_tile=interior).reset_index(drop=True)
+
+    return gpd.GeoDataFrame(attrs, geometry=pieces, crs=poly_gdf.crs)
+
+
+def query_tiled(input_geoms, selection_geoms, predicate='intersects', max_vertices=200):
+    """
+    Same result as shapely.STRtree(input_geoms).query(selection_geoms, predicate=predicate), i.e., 2 x N array of
+    [selection geom position, input geom position] pairs, but tests input geometries against small tiled pieces
+    of the selection geometries instead of the whole (possibly very large) selection geometries.
+    """
+    input_geoms = np.asarray(input_geoms, dtype=object)
+    selection_geoms = np.asarray(selection_geoms, dtype=object)
+
+    pieces, src, interior = tile_polygons(selection_geoms, max_vertices=max_vertices)
+    shapely.prepare(pieces)
+
+    # candidate pairs: features that intersect any piece of a selection geometry
+    tree = shapely.STRtree(input_geoms)
+    pc_idx, in_idx = tree.query(pieces, predicate='intersects')
+
+    if predicate != 'intersects':
+        cand_geoms = input_geoms[in_idx]
+        all_points = bool((shapely.get_type_id(input_geoms) == 0).all())
+        if predicate == 'covers' and all_points:
+            # points are covered by a polygon if they are covered by one of its pieces.
+            # Points that intersect an interior tile are accepted without further checks.
+            is_selected = interior[pc_idx] | shapely.covers(pieces[pc_idx], cand_geoms)
+        else:
+            # features entirely inside an interior tile are accepted for 'covers'. All others are checked
+            # against the whole (prepared) selection geometry.
+            is_selected = np.zeros(len(pc_idx), dtype=bool)
+            if predicate == 'covers':
+                is_selected = interior[pc_idx] & shapely.covers(pieces[pc_idx], cand_geoms)
+            tocheck = ~is_selected
+            shapely.prepare(selection_geoms)
+            pred_func = getattr(shapely, predicate)
+            is_selected[tocheck] = pred_func(selection_geoms[src[pc_idx[tocheck]]], cand_geoms[tocheck])
+
+        pc_idx, in_idx = pc_idx[is_selected], in_idx[is_selected]
+
+    # a feature hitting several pieces of the same selection geometry is only returned once for it
+    pairs = np.unique(np.column_stack([src[pc_idx], in_idx]), axis=0)
+
+    return pairs.T
+
+
+if __name__ == '__main__':
+    # benchmark: random points against a single jagged polygon with many vertices, similar to a county boundary
+    n_vertices = 50_000
+    n_points = 500_000
+
+    rng = np.random.default_rng(0)
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    radii = 50_000 * (1 + 0.05 * rng.standard_normal(n_vertices))
+    big_poly = shapely.Polygon(np.column_stack([radii * np.cos(angles), radii * np.sin(angles)]))
+    pts = shapely.points(rng.uniform(-60_000, 60_000, (n_points, 2)))
+
+    st = perf_counter()
+    untiled = shapely.STRtree(pts).query([big_poly], predicate='covers')
+    untiled_sec = perf_counter() - st
+
+    st = perf_counter()
+    tiled = query_tiled(pts, [big_poly], predicate='covers')
+    tiled_sec = perf_counter() - st
+
+    assert np.array_equal(np.sort(untiled[1]), tiled[1])
+    print(f"{n_points} points vs. 1 polygon with {n_vertices} vertices: {tiled.shape[1]} points selected")
+    print(f"\tuntiled: {round(untiled_sec, 2)} seconds; tiled: {round(tiled_sec, 2)} seconds " \
+          f"({round(untiled_sec / tiled_sec, 1)}x speedup)")
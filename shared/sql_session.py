@@ -0,0 +1,364 @@
+"""
+Name: sql_session.py
+Purpose: Reusable SQL Server session with a connection pool, shared by the SQL helper scripts
+    (sqlqry2pandas.py, association.py, update_spatial_tag.py, etc.)
+
+    Before, each call to run a query looked up the ODBC driver, rebuilt the connection string, and opened
+    a brand new connection. When tagging scripts run thousands of statements, login time dominates run time.
+    A SqlSession instead:
+        - looks up the ODBC driver once per process
+        - keeps a bounded pool of open connections (SQLAlchemy QueuePool). Connections are pinged before they
+            are handed out, so connections dropped by the server are replaced instead of raising errors.
+        - has execute(), executemany(), iter_arrow_batches() and query_to_arrow() methods that borrow a pooled connection
+        - if the arrow-odbc package is installed, keeps a second bounded pool of arrow-odbc connections, which
+            iter_arrow_batches() uses to fetch SQL Server results straight into Arrow buffers
+        - can read a large query as partitions split on a key field, fetched concurrently on several pooled
+            connections (see iter_partitions())
+        - keeps timing counters for each statement it runs (see timing_report())
+
+    Use get_session() to get the session for a database; sessions are reused for the life of the process.
+    Any SQLAlchemy URL can be given instead of a SQL Server database, e.g. 'sqlite:///test.db' for testing.
+
+
+Author: Darren Conly
+Last Updated: Oct 2026
+Updated by:
+Copyright:   (c) SACOG
+Python Version: 3.x
+"""
+import re
+import queue
+import urllib
+import datetime as dt
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from functools import lru_cache
+from time import perf_counter
+
+import pandas as pd
+import pyarrow as pa
+import sqlalchemy as sqla
+
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None # only needed for SQL Server connections
+
+try:
+    import arrow_odbc
+except (ImportError, OSError):
+    arrow_odbc = None # optional. Fetches SQL Server results straight into Arrow buffers (columnar) in native code.
+    # OSError is raised if arrow_odbc is installed but the ODBC driver manager library is not.
+
+# {python type in cursor.description: arrow type}. Types not listed here (and SQLite, which does not report
+# column types) are inferred from the values.
+PY_TO_ARROW_TYPES = {
+    int: pa.int64(), float: pa.float64(), str: pa.string(), bool: pa.bool_(),
+    dt.datetime: pa.timestamp('us'), dt.date: pa.date32(), bytes: pa.binary(), bytearray: pa.binary()
+}
+
+
+@lru_cache(maxsize=None)
+def get_odbc_driver():
+    # gets name of ODBC driver, with name "ODBC Driver <version> for SQL Server". Only looked up once per process.
+    drivers = [d for d in pyodbc.drivers() if 'ODBC Driver ' in d] if pyodbc else []
+
+    if len(drivers) == 0:
+        errmsg = f"ERROR. No usable ODBC Driver found for SQL Server." \
+        f"drivers found include {drivers}. Check ODBC Administrator program" \
+        "for more information."
+
+        raise Exception (errmsg)
+    else:
+        d_versions = [re.findall(r'\d+', dv)[0] for dv in drivers]
+        latest_version = max([int(v) for v in d_versions])
+        driver = f"ODBC Driver {latest_version} for SQL Server"
+
+        return driver
+
+
+class SqlSession:
+    """
+    Pool of connections to one database.
+    dbname, servername, trustedconn = SQL Server database to connect to
+    pool_size = max number of open connections. If all are in use, callers wait for one to be returned.
+        With arrow-odbc installed, up to pool_size arrow-odbc connections can be open too.
+    engine_url = SQLAlchemy URL to use instead of SQL Server connection info (e.g. 'sqlite:///test.db'). Optional.
+    recycle_secs = connections older than this are closed and reopened when next used.
+    """
+    def __init__(self, dbname=None, servername='SQL-SVR', trustedconn='yes', pool_size=5, engine_url=None,
+                 recycle_secs=3600):
+        self.dbname = dbname
+        self.pool_size = pool_size
+        self.conn_str = None # pyodbc connection string. Only for SQL Server sessions.
+
+        if not engine_url:
+            self.conn_str = f"DRIVER={get_odbc_driver()};" \
+                f"SERVER={servername};" \
+                f"DATABASE={dbname};" \
+                f"Trusted_Connection={trustedconn};"
+            engine_url = f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(self.conn_str)}"
+
+        # max_overflow=0 keeps the pool bounded; pool_pre_ping is the health check on checkout
+        self.engine = sqla.create_engine(engine_url, poolclass=sqla.pool.QueuePool, pool_size=pool_size,
+                                         max_overflow=0, pool_pre_ping=True, pool_recycle=recycle_secs)
+
+        # arrow-odbc connections are not DB-API connections, so they cannot go in the SQLAlchemy pool. They get a pool
+        # of their own, with the same size limit, and are reused across queries instead of logging in for each one.
+        self._arrow_conns = queue.LifoQueue() # idle arrow-odbc connections
+        self._arrow_slots = threading.BoundedSemaphore(pool_size) # one per arrow-odbc connection in use
+
+        self.timing = {} # {statement: [number of runs, total seconds, total rows]}
+        self._timing_lock = threading.Lock()
+
+    def _record(self, label, sql_str, start_time, rowcnt):
+        key = label or ' '.join(sql_str.split())[:80]
+        et_sec = perf_counter() - start_time
+        with self._timing_lock:
+            stats = self.timing.setdefault(key, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += et_sec
+            stats[2] += max(rowcnt, 0) # rowcount is -1 if the driver does not know it
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a DB-API connection from the pool. Changes are committed when the with block finishes,
+        or rolled back if it raises an error. Connection goes back to the pool either way.
+        """
+        conn = self.engine.raw_connection()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close() # returns it to the pool
+
+    @contextmanager
+    def arrow_odbc_connection(self):
+        """
+        Borrows an arrow-odbc connection from the session's arrow-odbc pool, opening a new one only if none is idle.
+        Waits if pool_size arrow-odbc connections are already in use. A connection whose with block raises an
+        error (or is left before its results are read) is closed instead of going back to the pool.
+        """
+        self._arrow_slots.acquire()
+        reusable = False
+        try:
+            try:
+                conn = self._arrow_conns.get_nowait()
+            except queue.Empty:
+                conn = arrow_odbc.connect(self.conn_str)
+
+            yield conn
+            reusable = True
+        finally:
+            if reusable: self._arrow_conns.put(conn)
+            self._arrow_slots.release()
+
+    def execute(self, sql_str, params=None, label=None):
+        """
+        Runs single SQL statement and commits it. Returns number of rows affected.
+        params = sequence of values for ? placeholders in sql_str. Optional.
+        label = name to record timing under. Defaults to start of sql_str.
+        """
+        start_time = perf_counter()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql_str, params or ())
+            rowcnt = cur.rowcount
+            cur.close()
+
+        self._record(label, sql_str, start_time, rowcnt)
+        return rowcnt
+
+    def executemany(self, sql_str, rows, batch_size=50_000, label=None):
+        """
+        Runs sql_str once for each row of parameter values in rows, in batches, and commits them all together.
+        Uses pyodbc's fast_executemany for SQL Server. Returns number of rows sent.
+        """
+        rows = list(rows)
+        start_time = perf_counter()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            if hasattr(cur, 'fast_executemany'): cur.fast_executemany = True # pyodbc only
+            for i in range(0, len(rows), batch_size):
+                cur.executemany(sql_str, rows[i:i + batch_size])
+            cur.close()
+
+        self._record(label, sql_str, start_time, len(rows))
+        return len(rows)
+
+    def iter_arrow_batches(self, sql_str, params=None, batch_rows=100_000, label=None):
+        """
+        Runs query and yields results as pyarrow record batches of up to batch_rows rows. If the query returns
+        no rows, one empty batch is yielded so that column names are still available.
+
+        For SQL Server sessions with the arrow-odbc package installed, this is a columnar fetch: arrow-odbc reads rows
+        straight into typed Arrow buffers, without making a Python object for each value, on a connection from the
+        session's arrow-odbc pool. Otherwise it is a row fetch: rows come back from a pooled connection as Python
+        tuples and are converted to Arrow one batch at a time, with types from the cursor description. That saves
+        memory compared with a dataframe of Python objects, but not the cost of making them.
+        """
+        start_time = perf_counter()
+        rowcnt = 0
+
+        if arrow_odbc and self.conn_str:
+            qparams = None if params is None else [None if p is None else str(p) for p in params]
+            with self.arrow_odbc_connection() as conn:
+                reader = conn.read_arrow_batches(query=sql_str, batch_size=batch_rows, parameters=qparams)
+                if len(reader.schema) == 0:
+                    raise Exception(f"ERROR: query did not return rows: {sql_str}")
+
+                for batch in reader:
+                    rowcnt += batch.num_rows
+                    yield batch
+
+            if rowcnt == 0:
+                yield pa.RecordBatch.from_pylist([], schema=reader.schema)
+        else:
+            with self.connection() as conn:
+                cur = conn.cursor()
+                cur.execute(sql_str, params or ())
+                if cur.description is None:
+                    raise Exception(f"ERROR: query did not return rows: {sql_str}")
+                names = [d[0] for d in cur.description]
+                types = [PY_TO_ARROW_TYPES.get(d[1]) for d in cur.description]
+
+                while True:
+                    rows = cur.fetchmany(batch_rows)
+                    if not rows: break
+                    cols = [pa.array(col, type=t) for col, t in zip(zip(*rows), types)]
+                    rowcnt += len(rows)
+                    yield pa.RecordBatch.from_arrays(cols, names=names)
+                cur.close()
+
+            if rowcnt == 0:
+                yield pa.RecordBatch.from_arrays([pa.array([], type=t or pa.null()) for t in types], names=names)
+
+        self._record(label, sql_str, start_time, rowcnt)
+
+    def query_to_arrow(self, sql_str, params=None, batch_rows=100_000, label=None):
+        # runs query and returns results as a pyarrow table
+        tbls = [pa.Table.from_batches([b]) for b in self.iter_arrow_batches(sql_str, params=params,
+                                                                            batch_rows=batch_rows, label=label)]
+
+        # a column that is all null in one batch is promoted to the type it has in other batches
+        return pa.concat_tables(tbls, promote_options='default')
+
+    def partition_queries(self, sql_str, partition_field, n_partitions):
+        """
+        Splits query into about n_partitions queries with the same number of rows each, as key ranges of
+        partition_field (keyset partitioning). Range boundaries come from an NTILE() over partition_field.
+        Rows with a null partition_field get their own partition.
+        Returns list of (query, params) tuples.
+        """
+        base = f"SELECT * FROM ({sql_str}) q"
+        cnt_qry = f"SELECT COUNT(*) AS n_all, COUNT({partition_field}) AS n_key FROM ({sql_str}) q"
+        n_all, n_key = self.query_to_arrow(cnt_qry).to_pylist()[0].values()
+
+        parts = []
+        if n_key > 0:
+            tile_qry = f"SELECT MIN(pf) AS lo FROM (SELECT {partition_field} AS pf, " \
+                f"NTILE({int(n_partitions)}) OVER (ORDER BY {partition_field}) AS tile " \
+                f"FROM ({sql_str}) q WHERE {partition_field} IS NOT NULL) t GROUP BY tile"
+
+            # half-open ranges, so that a key value is only ever in one partition even if it is not unique
+            lows = sorted(set(self.query_to_arrow(tile_qry).column('lo').to_pylist()))
+            for lo, hi in zip(lows, lows[1:]):
+                parts.append((f"{base} WHERE {partition_field} >= ? AND {partition_field} < ?", (lo, hi)))
+            parts.append((f"{base} WHERE {partition_field} >= ?", (lows[-1],)))
+
+        if n_all > n_key:
+            parts.append((f"{base} WHERE {partition_field} IS NULL", None))
+
+        return parts
+
+    def iter_partitions(self, sql_str, partition_field, n_partitions, workers=None, ordered=False):
+        """
+        Reads query as partitions split on partition_field (see partition_queries()), running up to workers
+        partitions at a time. Yields a pyarrow table per partition.
+        Each partition is read with query_to_arrow() on a connection borrowed from the session's pools: the
+        arrow-odbc pool if arrow-odbc is installed, otherwise the SQLAlchemy pool. No partition opens a connection of
+        its own, so a partitioned read never has more than pool_size connections of either kind open.
+        workers = number of partitions to read at once. Defaults to session pool size.
+        ordered = if True, partitions are yielded in partition_field order. If False, they are yielded as soon as
+            each one finishes.
+        The query must be usable as a subquery (e.g. no ORDER BY or SET NOCOUNT ON).
+        """
+        workers = min(workers or self.pool_size, self.pool_size)
+        todo = list(enumerate(self.partition_queries(sql_str, partition_field, n_partitions)))[::-1]
+
+        running = {} # {future: partition number}
+        finished = {} # {partition number: table}, for partitions waiting to be yielded in order
+        next_part = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while todo or running:
+                # results waiting to be yielded count against workers, so memory use stays bounded
+                while todo and len(running) + len(finished) < workers:
+                    i, (qry, params) = todo.pop()
+                    running[executor.submit(self.query_to_arrow, qry, params=params)] = i
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    i = running.pop(fut)
+                    if ordered:
+                        finished[i] = fut.result()
+                    else:
+                        yield fut.result()
+
+                while next_part in finished:
+                    yield finished.pop(next_part)
+                    next_part += 1
+
+    def timing_report(self):
+        # returns dataframe of run count, total seconds and total rows for each statement, slowest first
+        with self._timing_lock:
+            data = [[k] + list(v) for k, v in self.timing.items()]
+        df = pd.DataFrame(data, columns=['statement', 'runs', 'total_secs', 'rows'])
+
+        return df.sort_values('total_secs', ascending=False).reset_index(drop=True)
+
+    def close(self):
+        # closes all pooled connections
+        self.engine.dispose()
+        while not self._arrow_conns.empty():
+            self._arrow_conns.get_nowait() # arrow-odbc connection is closed when it is garbage collected
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(dbname=None, servername='SQL-SVR', trustedconn='yes', engine_url=None, pool_size=5):
+    """
+    Returns SqlSession for the database, creating it the first time it is asked for. Later calls with the
+    same database reuse the same session and its open connections.
+    """
+    key = (engine_url,) if engine_url else (dbname, servername, trustedconn)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = SqlSession(dbname, servername=servername, trustedconn=trustedconn,
+                                        pool_size=pool_size, engine_url=engine_url)
+
+    return _sessions[key]
+
+
+if __name__ == '__main__':
+    # example using a SQLite file as a local stand-in for SQL Server
+    import os
+    import tempfile
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'test.db')
+    sess = get_session(engine_url=f"sqlite:///{db_path}")
+
+    sess.execute("CREATE TABLE parcels (PARCELID INTEGER PRIMARY KEY, XCOORD REAL, YCOORD REAL, EJ INTEGER)")
+    sess.executemany("INSERT INTO parcels VALUES (?, ?, ?, 0)", [(i, i * 10.0, i * 5.0) for i in range(100_000)])
+    for i in range(100):
+        sess.execute("UPDATE parcels SET EJ = 1 WHERE PARCELID = ?", params=(i,), label='tag one parcel')
+    tbl = sess.query_to_arrow("SELECT * FROM parcels WHERE EJ = 1")
+
+    print(tbl.schema)
+    print(sess.timing_report())
+    sess.close()
@@ -0,0 +1,143 @@
+"""
+Name: pandas2sqltable.py
+Purpose: Make dataframe from SQL Server query results
+    https://docs.microsoft.com/en-us/sql/machine-learning/data-exploration/python-dataframe-sql-server?view=sql-server-ver15
+        
+          
+Author: Darren Conly
+Last Updated: Apr 2021
+Updated by: <name>
+Copyright:   (c) SACOG
+Python Version: 3.x
+"""
+import math
+from time import perf_counter as perf
+
+import pandas as pd
+import pyarrow as pa
+import sqlalchemy as sqla # needed to run pandas df.to_sql() function
+
+from sql_session import get_odbc_driver, get_session
+
+
+def arrow_to_df(arrow_data, xy_fields=None, crs=None):
+    """
+    Converts pyarrow table or record batch to pandas dataframe. Numeric columns without nulls are not copied.
+    xy_fields = (x field, y field). If specified, returns geodataframe with point geometry made from those fields.
+    crs = CRS of the x/y values, e.g. 'EPSG:2226'
+    """
+    if isinstance(arrow_data, pa.RecordBatch):
+        arrow_data = pa.Table.from_batches([arrow_data])
+
+    # split_blocks avoids consolidating columns into 2D blocks, which would copy them
+    df = arrow_data.to_pandas(split_blocks=True, self_destruct=True)
+
+    return add_xy_geometry(df, xy_fields, crs) if xy_fields else df
+
+
+def add_xy_geometry(df, xy_fields, crs=None):
+    # returns geodataframe with point geometry made from xy_fields = (x field, y field)
+    import geopandas as gpd
+
+    f_x, f_y = xy_fields
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[f_x].to_numpy(), df[f_y].to_numpy()), crs=crs)
+
+
+def _iter_arrow_dfs(batches, xy_fields, crs):
+    # batches = record batches or tables
+    for batch in batches:
+        yield arrow_to_df(batch, xy_fields=xy_fields, crs=crs)
+
+
+def _iter_xy_dfs(dfs, xy_fields, crs):
+    for df in dfs:
+        yield add_xy_geometry(df, xy_fields, crs)
+
+
+# extract SQL Server query results into a pandas dataframe   
+def sqlqry_to_df(query_str, dbname, servername='SQL-SVR', trustedconn='yes', chunk_size=None,
+                 use_arrow=False, xy_fields=None, crs=None, engine_url=None,
+                 partition_field=None, workers=4, ordered=False):
+    """
+    Returns dataframe of query results, or if chunk_size is specified, an iterator of dataframes with up to
+    chunk_size rows each.
+    use_arrow = if True, results are fetched as Arrow record batches with typed columns (see
+        SqlSession.iter_arrow_batches) instead of going through pd.read_sql_query. Much faster for large tables
+        if the arrow-odbc package is installed, which fetches columns without making a Python object for every value.
+    xy_fields = (x field, y field). If specified, returns geodataframe(s) with point geometry made from those fields.
+    crs = CRS of the x/y values, e.g. 'EPSG:2226'
+    engine_url = SQLAlchemy URL to query instead of SQL Server (e.g. 'sqlite:///test.db' for testing). Optional.
+    partition_field = if specified, query is split into ranges of this field (e.g. parcel ID), which are read
+        concurrently on the session's pooled connections (see SqlSession.iter_partitions). Always uses Arrow.
+        With chunk_size, there is one partition per chunk_size rows, yielded as they finish; without it, all
+        partitions are combined into one dataframe.
+    workers = number of partitions read at once, in partitioned reads
+    ordered = if True, partitioned reads yield chunks in partition_field order instead of as they finish
+    """
+
+    # engine comes from a shared session, so its connections are pooled and reused across calls
+    session = get_session(dbname, servername=servername, trustedconn=trustedconn, engine_url=engine_url)
+    engine = session.engine
+       
+    start_time = perf()
+
+    # create SQL table from the dataframe
+    print("Executing query. Results loading into dataframe...")
+    if partition_field:
+        if chunk_size:
+            n_rows = session.query_to_arrow(f"SELECT COUNT(*) AS n FROM ({query_str}) q").column('n')[0].as_py()
+            n_parts = max(math.ceil(n_rows / chunk_size), 1)
+        else:
+            n_parts = workers
+        tbls = session.iter_partitions(query_str, partition_field, n_parts, workers=workers, ordered=ordered)
+        if chunk_size:
+            return _iter_arrow_dfs(tbls, xy_fields, crs)
+
+        tbl = pa.concat_tables(list(tbls), promote_options='default')
+        df = arrow_to_df(tbl, xy_fields=xy_fields, crs=crs)
+    elif use_arrow:
+        batches = session.iter_arrow_batches(query_str, batch_rows=chunk_size or 100_000)
+        if chunk_size:
+            return _iter_arrow_dfs(batches, xy_fields, crs)
+
+        tbl = pa.concat_tables([pa.Table.from_batches([b]) for b in batches], promote_options='default')
+        df = arrow_to_df(tbl, xy_fields=xy_fields, crs=crs)
+    else:
+        try:
+            df = pd.read_sql_query(sql=query_str, con=engine, chunksize=chunk_size)
+        except sqla.exc.ResourceClosedError:
+            msg = """ResourceClosedError. Ensure that the query returns rows and that you have the following at the start of your query:
+            SET ANSI_WARNINGS OFF 
+            SET NOCOUNT ON
+            """
+            raise Exception(msg)
+
+        if xy_fields:
+            if chunk_size:
+                return _iter_xy_dfs(df, xy_fields, crs)
+            df = add_xy_geometry(df, xy_fields, crs)
+    
+    if not chunk_size:
+        rowcnt = df.shape[0]
+        
+        et_mins = round((perf() - start_time) / 60, 2)
+        print(f"Successfully executed query in {et_mins} minutes. {rowcnt} rows loaded into dataframe.")
+    
+    return df
+    
+
+
+
+if __name__ == '__main__':
+    
+    #==========Make dataframe from SQL Server query========
+    db = 'NPMRDS'
+    qry = 'SELECT TOP 10 * FROM npmrds_2017_alltmc_trucks'
+    
+    tdf = sqlqry_to_df(qry, db)
+    
+    
+    
+        
+    
+    